@@ -13,6 +13,7 @@ from handlers import promo as promo_handlers
 from handlers import gift as gift_handlers
 from handlers import referral as referral_handlers
 from handlers import broadcast as broadcast_handlers  # <-- добавили рассылку
+from services import generation_service
 
 
 async def main() -> None:
@@ -34,6 +35,7 @@ async def main() -> None:
     logger.info("BOT_USERNAME: %s", getattr(settings, "BOT_USERNAME", "") or "(not set)")
 
     await migrate()
+    await generation_service.warmup()
 
     bot_token = settings.BOT_TOKEN or settings.TG_BOT_TOKEN
     if not bot_token:
@@ -53,7 +55,10 @@ async def main() -> None:
     dp.include_router(referral_handlers.router)
     dp.include_router(broadcast_handlers.router)  # <-- подключили роутер рассылки
 
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+    try:
+        await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+    finally:
+        await generation_service.shutdown()
 
 
 if __name__ == "__main__":
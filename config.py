@@ -140,6 +140,8 @@ class Settings(BaseModel):
     POLL_TIMEOUT: int = int(os.getenv("POLL_TIMEOUT", 25))
     JOB_POLL_INTERVAL_SEC: int = int(os.getenv("JOB_POLL_INTERVAL_SEC", 8))
     JOB_MAX_WAIT_MIN: int = int(os.getenv("JOB_MAX_WAIT_MIN", 20))
+    # множитель интервала опроса Google Veo (services/providers/veo.py): 2с → 3с → 4.5с … до потолка
+    VEO_POLL_BACKOFF: float = float(os.getenv("VEO_POLL_BACKOFF", 1.5))
 
     # Модерация текста
     TEXT_BLOCK_SCORE: float = float(os.getenv("TEXT_BLOCK_SCORE", 0.8))
@@ -157,9 +159,15 @@ class Settings(BaseModel):
 
     # Доп. настройки кодека/логирования для media_tools (опционально)
     VIDEO_CRF: int = int(os.getenv("VIDEO_CRF", 18))
-    FFMPEG_PRESET: str = os.getenv("FFMPEG_PRESET", "slow")
+    FFMPEG_PRESET: str = os.getenv("FFMPEG_PRESET", "faster")
     FFMPEG_LOG_CMD: bool = os.getenv("FFMPEG_LOG_CMD", "0").lower() in ("1", "true", "yes")
 
+    # Куда провайдеры складывают скачанные ролики (пусто — текущая рабочая директория)
+    DOWNLOAD_DIR: str = os.getenv("DOWNLOAD_DIR", "")
+    # Нормализовать ролик прямо из HTTP-потока (ffmpeg -i pipe:0), без промежуточного файла.
+    # Без cropdetect: «впаянные» полосы на этом пути не вырезаются.
+    NORMALIZE_FROM_STREAM: bool = os.getenv("NORMALIZE_FROM_STREAM", "0").lower() in ("1", "true", "yes")
+
     # Точность сравнений баланса (для анти-флота при списаниях)
     TOKENS_EPSILON: float = float(os.getenv("TOKENS_EPSILON", 1e-9))
 
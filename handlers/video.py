@@ -3,6 +3,7 @@ from __future__ import annotations
 
 import logging
 import os
+import re
 from contextlib import suppress
 from pathlib import Path
 from typing import Any, Optional, Tuple
@@ -37,8 +38,8 @@ from providers.models import GenerationParams
 from services import generation_service
 from services.moderation import check_text
 from services.media_tools import (
-    enforce_ar_no_bars,
-    build_vertical_blurpad,
+    enforce_ar_no_bars_async,
+    build_vertical_blurpad_async,
 )
 from texts import WELCOME, INSUFFICIENT_TOKENS
 
@@ -79,6 +80,10 @@ VEO_DEFAULT_STATE: dict[str, Any] = {
 SUMMARY_META_KEY = "veo_summary_message"
 DATA_KEY = "veo_state"
 
+# классификация ошибок сабмита: один проход regex без копии .lower()
+_SUBMIT_NO_FUNDS_RE = re.compile(r"insufficient_balance|payment required|402", re.IGNORECASE)
+_SUBMIT_QUOTA_RE = re.compile(r"resource_exhausted|quota|rate limit", re.IGNORECASE)
+
 # ---- стоимость (из settings / .env, с дефолтами) ----
 def _veo_costs() -> tuple[float, float]:
     fast = getattr(settings, "VEO_COST_FAST_TOKENS", None)
@@ -288,10 +293,10 @@ async def _normalize_result(src: Path, aspect: str) -> Path:
     try:
         if aspect == "9:16":
             dst = src.with_name(src.stem + "_blurpad.mp4")
-            await asyncio.to_thread(build_vertical_blurpad, str(src), str(dst))
+            await build_vertical_blurpad_async(src, dst)
         else:
             dst = src.with_name(src.stem + "_normalized.mp4")
-            await asyncio.to_thread(enforce_ar_no_bars, str(src), str(dst), "16:9")
+            await enforce_ar_no_bars_async(src, dst, "16:9")
         return dst if dst.exists() else src
     except Exception as exc:
         log.exception("output normalization failed: %s", exc)
@@ -504,13 +509,12 @@ async def veo_callback(cb: CallbackQuery, state: FSMContext) -> None:
                     await refund_user_tokens(db, user_id, expected_cost)
             log.exception("Veo3 submit failed: %s", exc)
             txt = str(exc)
-            low = txt.lower()
-            if "INSUFFICIENT_BALANCE" in txt or "payment required" in low or "402" in low:
+            if _SUBMIT_NO_FUNDS_RE.search(txt):
                 await status_message.edit_text(
                     "❗ Не удалось начать генерацию: недостаточно средств в Polza.ai.\n"
                     "Пополните баланс/повысьте лимит ключа и попробуйте снова."
                 )
-            elif "resource_exhausted" in low or "quota" in low or "rate limit" in low:
+            elif _SUBMIT_QUOTA_RE.search(txt):
                 await status_message.edit_text(
                     "❗ Не удалось начать генерацию: превышен лимит/квота провайдера.\n"
                     "Попробуйте позже или переключите режим на Fast."
@@ -520,10 +524,10 @@ async def veo_callback(cb: CallbackQuery, state: FSMContext) -> None:
             return
 
         poll_interval = max(3.0, settings.JOB_POLL_INTERVAL_SEC)
-        interval_plan = [6.0, 10.0, 15.0]
-        first_status = await generation_service.wait_for_completion(
-            Provider.VEO3, job_id_first, interval_sec=poll_interval,
-            timeout_sec=max(60.0, settings.JOB_MAX_WAIT_MIN * 60), interval_schedule=interval_plan
+        # все генерации бота ждут через общий JobPoller: один тик опроса на все активные задачи
+        poller = generation_service.get_job_poller(Provider.VEO3)
+        first_status = await poller.wait(
+            job_id_first, max(60.0, settings.JOB_MAX_WAIT_MIN * 60), interval_sec=poll_interval
         )
         if first_status.status != "succeeded":
             if should_charge:
@@ -616,9 +620,8 @@ async def veo_callback(cb: CallbackQuery, state: FSMContext) -> None:
             await status_message.edit_text("Видео отправлено (HQ-версию начать не удалось)")
             return
 
-        hq_status = await generation_service.wait_for_completion(
-            Provider.VEO3, job_id_hq, interval_sec=poll_interval,
-            timeout_sec=max(60.0, settings.JOB_MAX_WAIT_MIN * 60), interval_schedule=interval_plan
+        hq_status = await poller.wait(
+            job_id_hq, max(60.0, settings.JOB_MAX_WAIT_MIN * 60), interval_sec=poll_interval
         )
         if hq_status.status != "succeeded":
             await status_message.edit_text("Видео отправлено (HQ-версию сгенерировать не удалось)")
@@ -1016,7 +1019,7 @@ async def _run_luma_generation(
     poll_interval = max(3.0, settings.JOB_POLL_INTERVAL_SEC)
 
     # ==== НОВОЕ: трекинг стадий + таймаут ожидания ====
-    started_at = asyncio.get_event_loop().time()
+    started_at = asyncio.get_running_loop().time()
     max_wait = max(60.0, settings.JOB_MAX_WAIT_MIN * 60)
     last_state = None
     failure_text: str | None = None
@@ -1083,7 +1086,7 @@ async def _run_luma_generation(
                 raise
 
         # таймаут ожидания
-        if asyncio.get_event_loop().time() - started_at > max_wait:
+        if asyncio.get_running_loop().time() - started_at > max_wait:
             if should_charge:
                 async with connect() as db:
                     await _prepare(db)
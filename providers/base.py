@@ -1,13 +1,48 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
+from collections import OrderedDict
 from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from enum import Enum
 from pathlib import Path
-from typing import Any, Dict, Literal, Protocol, runtime_checkable
+from typing import Any, Dict, Literal, Optional, Protocol, runtime_checkable
 
 from providers.models import GenerationParams
 
+# orjson (опционально) — JSON ответов API в разы быстрее stdlib; ошибки разбора у обоих — ValueError
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:  # pragma: no cover - зависит от окружения
+    import json as _json
+    from json import loads as json_loads
+
+    def json_dumps(obj: Any) -> bytes:
+        """Тело запроса в байтах — как orjson.dumps."""
+        return _json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class LRUCache(OrderedDict):
+    """dict с ограничением размера: чтение/запись поднимают ключ, при переполнении вытесняются самые старые."""
+
+    def __init__(self, maxsize: int = 256) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        if key in self:
+            self.move_to_end(key)
+        super().__setitem__(key, value)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
+
 
 class Provider(str, Enum):
     """Supported video generation providers."""
@@ -28,6 +63,24 @@ class JobStatus:
     extra: Dict[str, Any] | None = None
 
 
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After (секунды или HTTP-дата) → сколько секунд подождать; None, если заголовка нет/он битый."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
 @runtime_checkable
 class VideoProvider(Protocol):
     """Common contract for video generation providers."""
@@ -4,16 +4,18 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
+import random
 import re
 import tempfile
 import time
 from pathlib import Path
-from typing import Any, Optional, Tuple
+from typing import Any, AsyncIterator, Optional, Tuple
+from urllib.parse import urlsplit
 
 import aiohttp
 
 from config import settings
-from providers.base import JobId, JobStatus, Provider, VideoProvider
+from providers.base import JobId, JobStatus, LRUCache, Provider, VideoProvider, json_loads, parse_retry_after
 from providers.models import GenerationParams
 
 log = logging.getLogger(__name__)
@@ -26,6 +28,39 @@ _ALLOWED_MODELS = {
 }
 _DEFAULT_MODEL = "ray-2"
 
+# Одна сессия на процесс: пул соединений с keep-alive — опрос раз в несколько секунд
+# не платит каждый раз за DNS + TCP + TLS
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        trust_env = os.getenv("HTTP_TRUST_ENV", "1").lower() in ("1", "true", "yes")
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60),
+            trust_env=trust_env,
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Закрывает общую сессию (на остановке бота)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def _jittered(delay: float) -> float:
+    # ±20%: ретраи разных задач не синхронизируются в залпы
+    return delay * random.uniform(0.8, 1.2)
+
+# чанк для стрима в ffmpeg (-i pipe:0): крупный — меньше переключений между сетью и пайпом
+_STREAM_CHUNK = 1 << 20
+
+# сколько ETag'ов опроса держим (LRU): хватает на все генерации «в полёте»
+_POLL_ETAGS_MAX = 256
+
 
 class LumaProvider(VideoProvider):
     """Video generation provider backed by Luma Dream Machine."""
@@ -42,6 +77,23 @@ class LumaProvider(VideoProvider):
         self._admin_bypass: bool = str(
             getattr(settings, "ADMIN_TOKENS_BYPASS", os.getenv("ADMIN_TOKENS_BYPASS", "1"))
         ).lower() in ("1", "true", "yes", "y")
+        # job_id -> (ETag, статус): пока генерация не изменилась, сервер отвечает 304 без тела.
+        # Размер ограничен: генерации, которые так и не дождались финала, не копятся навсегда
+        self._poll_etags: LRUCache = LRUCache(_POLL_ETAGS_MAX)
+
+    async def warmup(self) -> None:
+        """Прогрев на старте: создаём общую сессию и заранее резолвим DNS API Luma."""
+        await _get_session()
+        host = urlsplit(self._base_url).hostname
+        if not host:
+            return
+        try:
+            await asyncio.get_running_loop().getaddrinfo(host, 443)
+        except OSError as e:
+            log.debug("Luma warmup failed for %s: %s", host, e)
+
+    async def close(self) -> None:
+        await close_session()
 
     # ---------------------- TOKEN / ADMIN HELPERS ----------------------
 
@@ -251,19 +303,19 @@ class LumaProvider(VideoProvider):
             payload["aspect_ratio"] = params.aspect_ratio
 
         try:
-            async with aiohttp.ClientSession(trust_env=True) as session:
-                async with session.post(
-                    f"{self._base_url}/generations",
-                    headers=self._headers_json,
-                    json=payload,
-                    timeout=aiohttp.ClientTimeout(total=120),
-                ) as resp:
-                    text = await resp.text()
-                    if resp.status >= 400:
-                        log.error("Luma create_job failed %s: %s", resp.status, text)
-                        self._refund_if_needed(charged, user_id, cost)
-                        raise RuntimeError(f"Luma submit failed with status {resp.status}")
-                    data = await self._safe_json(resp, text)
+            session = await _get_session()
+            async with session.post(
+                f"{self._base_url}/generations",
+                headers=self._headers_json,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=120),
+            ) as resp:
+                body = await resp.read()
+                if resp.status >= 400:
+                    log.error("Luma create_job failed %s: %s", resp.status, body.decode("utf-8", "replace"))
+                    self._refund_if_needed(charged, user_id, cost)
+                    raise RuntimeError(f"Luma submit failed with status {resp.status}")
+                data = self._safe_json(body)
         except Exception:
             self._refund_if_needed(charged, user_id, cost)
             raise
@@ -277,48 +329,75 @@ class LumaProvider(VideoProvider):
 
     async def poll(self, job_id: JobId) -> JobStatus:
         """
-        Опрос статуса. 4xx — фатальная ошибка; 5xx и сетевые сбои — транзиентные:
+        Опрос статуса. 4xx — фатальная ошибка; 429, 5xx и сетевые сбои — транзиентные:
         возвращаем pending (с ретраями), чтобы внешний цикл продолжал опрос.
+        Retry-After сервера уходит в extra["retry_after"] — внешний цикл не опросит раньше.
+        Условный GET (If-None-Match): на 304 отдаём прошлый статус без повторного разбора.
         """
-        trust_env = os.getenv("HTTP_TRUST_ENV", "1").lower() in ("1", "true", "yes")
         retries = 3
         backoff_base = 1.5
+        key = str(job_id)
 
         for attempt in range(retries):
             try:
-                async with aiohttp.ClientSession(trust_env=trust_env) as session:
-                    async with session.get(
-                        f"{self._base_url}/generations/{job_id}",
-                        headers=self._headers_get,
-                        timeout=aiohttp.ClientTimeout(total=60),
-                    ) as resp:
-                        text = await resp.text()
-
-                        # 5xx — транзиентно
-                        if 500 <= resp.status < 600:
-                            log.warning("Luma poll transient %s: %s", resp.status, text)
-                            if attempt < retries - 1:
-                                await asyncio.sleep(backoff_base * (2 ** attempt))
-                                continue
-                            return JobStatus(status="pending", progress=0, extra={"state": "transient", "http": resp.status})
-
-                        # 4xx — клиентская ошибка
-                        if resp.status >= 400:
-                            log.error("Luma poll failed %s: %s", resp.status, text)
-                            raise RuntimeError(f"Luma poll failed with status {resp.status}")
-
-                        data = await self._safe_json(resp, text)
-                        state = data.get("state") or "pending"
-                        video_url = (data.get("assets") or {}).get("video")
-                        mapped_status = self._map_state(state)
-                        progress = 100 if mapped_status == "succeeded" and video_url else 0
-                        extra = {"video_url": video_url, "state": state}
-                        return JobStatus(status=mapped_status, progress=progress, extra=extra)
+                headers = self._headers_get
+                cached = self._poll_etags.get(key)
+                if cached:
+                    headers["If-None-Match"] = cached[0]
+                session = await _get_session()
+                async with session.get(
+                    f"{self._base_url}/generations/{job_id}",
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=60),
+                ) as resp:
+                    if resp.status == 304 and cached:
+                        return cached[1]
+                    body = await resp.read()
+
+                    # 429 — просят подождать: не долбим повторами, отдаём паузу внешнему циклу
+                    if resp.status == 429:
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        log.warning("Luma poll rate limited, Retry-After=%s", retry_after)
+                        return JobStatus(
+                            status="pending", progress=0,
+                            extra={"state": "rate_limited", "http": 429, "retry_after": retry_after},
+                        )
+
+                    # 5xx — транзиентно
+                    if 500 <= resp.status < 600:
+                        log.warning("Luma poll transient %s: %s", resp.status, body.decode("utf-8", "replace"))
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        if attempt < retries - 1:
+                            await asyncio.sleep(retry_after or _jittered(backoff_base * (2 ** attempt)))
+                            continue
+                        return JobStatus(
+                            status="pending", progress=0,
+                            extra={"state": "transient", "http": resp.status, "retry_after": retry_after},
+                        )
+
+                    # 4xx — клиентская ошибка
+                    if resp.status >= 400:
+                        log.error("Luma poll failed %s: %s", resp.status, body.decode("utf-8", "replace"))
+                        raise RuntimeError(f"Luma poll failed with status {resp.status}")
+
+                    data = self._safe_json(body)
+                    state = data.get("state") or "pending"
+                    video_url = (data.get("assets") or {}).get("video")
+                    mapped_status = self._map_state(state)
+                    progress = 100 if mapped_status == "succeeded" and video_url else 0
+                    extra = {"video_url": video_url, "state": state}
+                    status = JobStatus(status=mapped_status, progress=progress, extra=extra)
+                    etag = resp.headers.get("ETag")
+                    if etag and mapped_status in ("pending", "running"):
+                        self._poll_etags[key] = (etag, status)
+                    else:
+                        self._poll_etags.pop(key, None)
+                    return status
 
             except aiohttp.ClientError as e:
                 log.warning("Luma poll network error: %s (attempt %d)", e, attempt + 1)
                 if attempt < retries - 1:
-                    await asyncio.sleep(backoff_base * (2 ** attempt))
+                    await asyncio.sleep(_jittered(backoff_base * (2 ** attempt)))
                     continue
                 return JobStatus(status="pending", progress=0, extra={"state": "transient", "error": str(e)})
 
@@ -327,27 +406,49 @@ class LumaProvider(VideoProvider):
 
     async def download(self, job_id: JobId) -> Path:
         """Скачать готовое видео в кросс-платформенную temp-папку и вернуть путь."""
-        status = await self.poll(job_id)
-        video_url = (status.extra or {}).get("video_url") if status.extra else None
-        if not video_url:
-            raise RuntimeError("Luma download requested before video is ready")
+        video_url = await self._video_url(job_id)
+
+        session = await _get_session()
+        async with session.get(video_url, timeout=aiohttp.ClientTimeout(total=120)) as resp:
+            body = await resp.read()
+            if resp.status >= 400:
+                text = body.decode(errors="ignore") if body else ""
+                log.error("Luma download failed %s: %s", resp.status, text)
+                raise RuntimeError(f"Luma download failed with status {resp.status}")
+
+        output_path = self.download_target(job_id)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        output_path.write_bytes(body)
+        return output_path
 
-        async with aiohttp.ClientSession(trust_env=True) as session:
+    def download_target(self, job_id: JobId) -> Path:
+        """Кросс-платформенный (Windows/Linux/macOS) локальный путь для ролика задачи."""
+        safe_job = re.sub(r"[^a-zA-Z0-9._-]+", "_", str(job_id))
+        return Path(tempfile.gettempdir()) / "luma_cache" / f"luma_{int(time.time())}_{safe_job}.mp4"
+
+    async def download_stream(self, job_id: JobId) -> AsyncIterator[bytes]:
+        """
+        Отдаёт тело готового видео чанками по 1 МБ прямо из ответа (для ffmpeg -i pipe:0):
+        декод стартует до конца скачивания. Без ретраев — после первого чанка повтор невозможен.
+        """
+        video_url = await self._video_url(job_id)
+        try:
+            session = await _get_session()
             async with session.get(video_url, timeout=aiohttp.ClientTimeout(total=120)) as resp:
-                body = await resp.read()
                 if resp.status >= 400:
-                    text = body.decode(errors="ignore") if body else ""
-                    log.error("Luma download failed %s: %s", resp.status, text)
+                    log.error("Luma download failed %s", resp.status)
                     raise RuntimeError(f"Luma download failed with status {resp.status}")
+                async for chunk in resp.content.iter_chunked(_STREAM_CHUNK):
+                    yield chunk
+        except aiohttp.ClientError as exc:
+            raise RuntimeError(f"Luma download failed: {exc}") from exc
 
-        # Кросс-платформенный путь (Windows/Linux/macOS)
-        safe_job = re.sub(r"[^a-zA-Z0-9._-]+", "_", str(job_id))
-        tmpdir = Path(tempfile.gettempdir()) / "luma_cache"
-        tmpdir.mkdir(parents=True, exist_ok=True)
-
-        output_path = tmpdir / f"luma_{int(time.time())}_{safe_job}.mp4"
-        output_path.write_bytes(body)
-        return output_path
+    async def _video_url(self, job_id: JobId) -> str:
+        status = await self.poll(job_id)
+        video_url = (status.extra or {}).get("video_url") if status.extra else None
+        if not video_url:
+            raise RuntimeError("Luma download requested before video is ready")
+        return video_url
 
     def _map_state(self, state: str) -> str:
         lowered = (state or "").lower()
@@ -376,9 +477,10 @@ class LumaProvider(VideoProvider):
             "Accept": "application/json",
         }
 
-    async def _safe_json(self, resp: aiohttp.ClientResponse, text: str) -> dict[str, Any]:
+    def _safe_json(self, body: bytes) -> dict[str, Any]:
+        # сырые байты тела — сразу в парсер: без resp.text() и повторного декодирования
         try:
-            return await resp.json()
-        except Exception as exc:
-            log.error("Luma response non-json: %s", text)
+            return json_loads(body)
+        except ValueError as exc:
+            log.error("Luma response non-json: %s", body.decode("utf-8", "replace"))
             raise RuntimeError("Luma returned invalid JSON") from exc
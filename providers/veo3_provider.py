@@ -8,7 +8,8 @@ import random
 import re
 import time
 from pathlib import Path
-from typing import Any, Optional, Tuple
+from typing import Any, AsyncIterator, Optional, Tuple
+from urllib.parse import urlsplit
 
 import httpx
 from httpx import (
@@ -21,7 +22,7 @@ from httpx import (
 )
 
 from config import settings
-from providers.base import JobId, JobStatus, Provider, VideoProvider
+from providers.base import JobId, JobStatus, LRUCache, Provider, VideoProvider, json_loads, parse_retry_after
 from providers.models import GenerationParams
 
 log = logging.getLogger("providers.veo3_provider")
@@ -35,6 +36,17 @@ POLZA_MODEL_DEFAULT = os.getenv("POLZA_MODEL_DEFAULT", os.getenv("POLZA_MODEL",
 POLZA_MODEL_FAST    = os.getenv("POLZA_MODEL_FAST", "veo3-fast")
 POLZA_MODEL_QUALITY = os.getenv("POLZA_MODEL_QUALITY", "veo3")  # «качественный» проход
 
+_GENERATIONS_URL = f"{POLZA_BASE_URL}/videos/generations"
+
+# сколько сабмитов одновременно держим «в полёте» (бэкпрешер на пул соединений)
+_MAX_CONCURRENT_SUBMITS = max(1, int(os.getenv("POLZA_MAX_CONCURRENT_SUBMITS", "20")))
+
+# каталог для скачанных роликов: вычисляем один раз (CWD у долгоживущего процесса не меняется)
+_DOWNLOAD_DIR = Path(getattr(settings, "DOWNLOAD_DIR", "") or Path.cwd())
+
+# сколько ETag'ов опроса держим (LRU): хватает на все задачи «в полёте»
+_POLL_ETAGS_MAX = 256
+
 # НЕ допускаем слэши в имени файла, только буквы/цифры/._-
 _SANITIZE_JOB_ID = re.compile(r"[^a-zA-Z0-9._-]+")
 
@@ -66,13 +78,39 @@ async def _respect_submit_gap() -> None:
             await asyncio.sleep(wait + random.uniform(0, 0.2))
         _last_submit_ts = time.monotonic()
 
+# Один клиент на процесс: keep-alive пул вместо DNS + TCP + TLS на каждый опрос/сабмит
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=max(32, _MAX_CONCURRENT_SUBMITS),
+                keepalive_expiry=60.0,
+            ),
+        )
+    return _client
+
+async def close_client() -> None:
+    """Закрывает общий HTTP-клиент (на остановке бота)."""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+_BASE_HEADERS = {"Content-Type": "application/json"}
+# ключ читается один раз при импорте — собираем заголовки один раз и только читаем их
+_AUTH_HEADERS: dict[str, str] = (
+    {**_BASE_HEADERS, "Authorization": f"Bearer {POLZA_API_KEY}"} if POLZA_API_KEY else {}
+)
+
 def _auth_headers() -> dict:
-    if not POLZA_API_KEY:
+    """Общий (не мутируемый!) словарь заголовков авторизации Polza."""
+    if not _AUTH_HEADERS:
         raise RuntimeError("POLZA_API_KEY is not set")
-    return {
-        "Authorization": f"Bearer {POLZA_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    return _AUTH_HEADERS
 
 def _coalesce(*vals):
     for v in vals:
@@ -236,47 +274,62 @@ def _flatten_for_polza_top_level(inp: dict) -> dict:
             top["imageUrls"] = list(inp["imageUrls"])
     return {k: v for k, v in top.items() if v not in (None, "", [])}
 
+# пути к ссылке на видео в порядке приоритета. Шаг пути: ключ dict, индекс list, "*" — каждый
+# элемент list; последний шаг-кортеж — альтернативные ключи (берём первую непустую строку)
+_URL_KEYS = ("url", "downloadUrl", "download_uri", "downloadUri")
+_NESTED_URL_KEYS = ("url", "downloadUrl", "downloadUri")
+_URL_PATHS: tuple[tuple[Any, ...], ...] = (
+    (_URL_KEYS,),
+    *(
+        path
+        for parent in ("output", "result", "response")
+        for path in (
+            (parent, _URL_KEYS),
+            (parent, "video", _NESTED_URL_KEYS),
+            (parent, "videos", 0, _NESTED_URL_KEYS),
+            (parent, "resources", "*", _NESTED_URL_KEYS),
+        )
+    ),
+)
+
+def _walk_url(node: Any, path: tuple[Any, ...]) -> Optional[str]:
+    """Идёт по одному пути без промежуточных `or {}`; None — как только путь оборвался."""
+    for i, step in enumerate(path):
+        if isinstance(step, tuple):
+            if not isinstance(node, dict):
+                return None
+            for k in step:
+                v = node.get(k)
+                if isinstance(v, str) and v:
+                    return v
+            return None
+        if step == "*":
+            if not isinstance(node, list):
+                return None
+            for item in node:
+                hit = _walk_url(item, path[i + 1:])
+                if hit:
+                    return hit
+            return None
+        if isinstance(node, dict):
+            node = node.get(step)
+        elif isinstance(node, list) and isinstance(step, int) and step < len(node):
+            node = node[step]
+        else:
+            return None
+    return node if isinstance(node, str) and node else None
+
 def _extract_video_url(data: dict[str, Any]) -> Optional[str]:
     """
     Унифицированный парсинг ответа статуса на Polza:
     ищем url в output/result/videos[0].url, video.url, url, resources[*].url и т.п.
+    Первый найденный путь из _URL_PATHS выигрывает, остальные не обходим.
     """
-    candidates = []
-
-    # прямые поля
-    for k in ("url", "downloadUrl", "download_uri", "downloadUri"):
-        v = data.get(k)
-        if isinstance(v, str):
-            candidates.append(v)
-
-    # вложенные структуры
-    for parent_key in ("output", "result", "response"):
-        parent = data.get(parent_key) or {}
-        if isinstance(parent, dict):
-            for k in ("url", "downloadUrl", "download_uri", "downloadUri"):
-                v = parent.get(k)
-                if isinstance(v, str):
-                    candidates.append(v)
-            video = parent.get("video") or {}
-            if isinstance(video, dict):
-                vv = _coalesce(video.get("url"), video.get("downloadUrl"), video.get("downloadUri"))
-                if isinstance(vv, str):
-                    candidates.append(vv)
-            videos = parent.get("videos") or []
-            if isinstance(videos, list) and videos:
-                first = videos[0] or {}
-                vv = _coalesce(first.get("url"), first.get("downloadUrl"), first.get("downloadUri"))
-                if isinstance(vv, str):
-                    candidates.append(vv)
-            resources = parent.get("resources") or []
-            if isinstance(resources, list):
-                for it in resources:
-                    if isinstance(it, dict):
-                        vv = _coalesce(it.get("url"), it.get("downloadUrl"), it.get("downloadUri"))
-                        if isinstance(vv, str):
-                            candidates.append(vv)
-
-    return candidates[0] if candidates else None
+    for path in _URL_PATHS:
+        hit = _walk_url(data, path)
+        if hit:
+            return hit
+    return None
 
 def _normalize_status(val: Any) -> str:
     s = str(val or "").lower()
@@ -311,12 +364,31 @@ class Veo3Provider(VideoProvider):
     Сохраняем имя класса и интерфейс, чтобы остальной проект не менять.
     """
     name = Provider.VEO3
+    # общий на процесс лимит одновременных сабмитов
+    _submit_semaphore = asyncio.Semaphore(_MAX_CONCURRENT_SUBMITS)
 
     def __init__(self) -> None:
         if not POLZA_API_KEY:
             log.warning("POLZA_API_KEY is not set; submissions will fail")
         # карта: job_id -> (последний известный статус, видео-URL)
         self._jobs_cache: dict[str, dict] = {}
+        # job_id -> (ETag, статус): пока задача не изменилась, Polza может ответить 304 без тела.
+        # Размер ограничен: задачи, которые так и не дождались финала, не копятся навсегда
+        self._poll_etags: LRUCache = LRUCache(_POLL_ETAGS_MAX)
+
+    async def warmup(self) -> None:
+        """Прогрев на старте: создаём общий клиент и резолвим DNS Polza заранее, чтобы первый сабмит не платил за это."""
+        _get_client()
+        host = urlsplit(POLZA_BASE_URL).hostname
+        if not host:
+            return
+        try:
+            await asyncio.get_running_loop().getaddrinfo(host, 443)
+        except OSError as e:
+            log.debug("Polza warmup failed for %s: %s", host, e)
+
+    async def close(self) -> None:
+        await close_client()
 
     # ------------ SUBMIT (Polza) ------------
     async def create_job(self, params: GenerationParams) -> JobId:
@@ -326,22 +398,22 @@ class Veo3Provider(VideoProvider):
         resp: { id | requestId | taskId, ... }
         """
         inp = _build_polza_input(params)
-        payload = {
-            "model": _pick_model(params),
-            **_flatten_for_polza_top_level(inp),  # <-- дублируем ключевые поля в корень
-            "input": inp,                          # и оставляем nested-форму (совместимость)
-        }
+        # корень собираем прямо из плоской формы, без промежуточного словаря
+        payload = _flatten_for_polza_top_level(inp)  # <-- дублируем ключевые поля в корень
+        payload["model"] = _pick_model(params)
+        payload["input"] = inp                       # и оставляем nested-форму (совместимость)
 
         headers = _auth_headers()
         await _respect_submit_gap()
 
-        async with httpx.AsyncClient(timeout=httpx.Timeout(60.0)) as http:
-            r = await http.post(f"{POLZA_BASE_URL}/videos/generations", headers=headers, json=payload)
+        http = _get_client()
+        async with self._submit_semaphore:
+            r = await http.post(_GENERATIONS_URL, headers=headers, json=payload, timeout=httpx.Timeout(60.0))
 
         if r.status_code == 402:
             # дружелюбная ошибка «недостаточно средств»
             try:
-                err = r.json().get("error", {})
+                err = json_loads(r.content).get("error", {})
                 msg = err.get("message") or "Insufficient balance"
                 code = err.get("code") or "INSUFFICIENT_BALANCE"
             except Exception:
@@ -352,7 +424,7 @@ class Veo3Provider(VideoProvider):
             log.error("Polza submit failed %s %s\nBody: %s", r.status_code, r.reason_phrase, r.text)
             raise RuntimeError(f"Polza submission failed ({r.status_code})")
 
-        data = r.json()
+        data = json_loads(r.content)
         job_id = (
             data.get("id")
             or data.get("requestId")
@@ -373,21 +445,32 @@ class Veo3Provider(VideoProvider):
         """
         GET /api/v1/videos/{id}
         ожидаем { status, output: { url }, ... }
+        Условный GET (If-None-Match): на 304 отдаём прошлый статус без повторного разбора.
         """
-        headers = _auth_headers()
+        key = str(job_id)
 
         # 2 попытки на временные сетевые
         for attempt in range(2):
             try:
-                async with httpx.AsyncClient(timeout=httpx.Timeout(30.0)) as http:
-                    r = await http.get(f"{POLZA_BASE_URL}/videos/{job_id}", headers=headers)
+                cached = self._poll_etags.get(key)
+                # _auth_headers() общий — If-None-Match кладём в копию
+                headers = {**_auth_headers(), "If-None-Match": cached[0]} if cached else _auth_headers()
+                r = await _get_client().get(
+                    f"{POLZA_BASE_URL}/videos/{job_id}", headers=headers, timeout=httpx.Timeout(30.0)
+                )
+                if r.status_code == 304 and cached:
+                    return cached[1]
                 if r.status_code >= 400:
-                    if _is_transient_status(r.status_code) and attempt < 1:
-                        await asyncio.sleep(1.0)
+                    if not _is_transient_status(r.status_code):
+                        return JobStatus(status="failed", error=f"Polza status failed ({r.status_code})")
+                    # 429/5xx — задача жива, просто не сейчас: уважаем Retry-After
+                    retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                    if attempt < 1 and r.status_code != 429:
+                        await asyncio.sleep(retry_after or random.uniform(0.8, 1.2))
                         continue
-                    return JobStatus(status="failed", error=f"Polza status failed ({r.status_code})")
+                    return JobStatus(status="pending", extra={"http": r.status_code, "retry_after": retry_after})
 
-                data = r.json()
+                data = json_loads(r.content)
                 status_raw = data.get("status") or data.get("state")
                 status = _normalize_status(status_raw)
 
@@ -402,7 +485,13 @@ class Veo3Provider(VideoProvider):
                                 break
                             except Exception:
                                 pass
-                    return JobStatus(status="pending" if progress == 0 else "running", progress=progress)
+                    result = JobStatus(status="pending" if progress == 0 else "running", progress=progress)
+                    etag = r.headers.get("ETag")
+                    if etag:
+                        self._poll_etags[key] = (etag, result)
+                    return result
+
+                self._poll_etags.pop(key, None)
 
                 if status == "failed":
                     err = _coalesce(
@@ -423,7 +512,7 @@ class Veo3Provider(VideoProvider):
 
             except _TRANSIENT_ERRORS:
                 if attempt < 1:
-                    await asyncio.sleep(1.0)
+                    await asyncio.sleep(random.uniform(0.8, 1.2))
                     continue
                 return JobStatus(status="pending")
 
@@ -434,37 +523,26 @@ class Veo3Provider(VideoProvider):
         """
         Скачиваем готовое видео по URL из статуса.
         """
-        status = await self.poll(job_id)
-        video_url = (status.extra or {}).get("video_url")
-        if status.status != "succeeded" or not video_url:
-            raise RuntimeError("download called before generation finished or without URL")
-
-        # Берём только хвост id и санитизируем
-        short_id = str(job_id).split("/")[-1]
-        sanitized = _SANITIZE_JOB_ID.sub("_", short_id)
-        target = Path.cwd() / f"veo3_{int(time.time())}_{sanitized}.mp4"
+        video_url = await self._video_url(job_id)
+        target = self.download_target(job_id)
         target.parent.mkdir(parents=True, exist_ok=True)
 
         # несколько попыток на скачивание, stream + tmp → rename
         for attempt in range(3):
             try:
-                async with httpx.AsyncClient(
-                    timeout=httpx.Timeout(300.0),
-                    follow_redirects=True,
-                ) as http:
-                    async with http.stream("GET", video_url) as resp:
-                        if resp.status_code >= 400:
-                            if _is_transient_status(resp.status_code) and attempt < 2:
-                                await asyncio.sleep(1.5 * (attempt + 1))
-                                continue
-                            resp.raise_for_status()
-                        tmp = target.with_suffix(".tmp")
-                        with tmp.open("wb") as f:
-                            async for chunk in resp.aiter_bytes(64 * 1024):
-                                if chunk:
-                                    f.write(chunk)
-                        tmp.replace(target)
-                        return target
+                async with _get_client().stream("GET", video_url, timeout=httpx.Timeout(300.0)) as resp:
+                    if resp.status_code >= 400:
+                        if _is_transient_status(resp.status_code) and attempt < 2:
+                            await asyncio.sleep(1.5 * (attempt + 1))
+                            continue
+                        resp.raise_for_status()
+                    tmp = target.with_suffix(".tmp")
+                    with tmp.open("wb") as f:
+                        async for chunk in resp.aiter_bytes(64 * 1024):
+                            if chunk:
+                                f.write(chunk)
+                    tmp.replace(target)
+                    return target
             except _TRANSIENT_ERRORS as exc:
                 if attempt < 2:
                     await asyncio.sleep(1.5 * (attempt + 1))
@@ -475,5 +553,33 @@ class Veo3Provider(VideoProvider):
 
         raise RuntimeError("download failed after retries")
 
+    def download_target(self, job_id: JobId) -> Path:
+        """Локальный путь для ролика задачи (берём только хвост id и санитизируем)."""
+        short_id = str(job_id).split("/")[-1]
+        sanitized = _SANITIZE_JOB_ID.sub("_", short_id)
+        return _DOWNLOAD_DIR / f"veo3_{int(time.time())}_{sanitized}.mp4"
+
+    async def download_stream(self, job_id: JobId) -> AsyncIterator[bytes]:
+        """
+        Отдаёт тело готового видео чанками, без записи на диск (для ffmpeg -i pipe:0).
+        Без ретраев: после первого отданного чанка повтор уже невозможен.
+        """
+        video_url = await self._video_url(job_id)
+        try:
+            async with _get_client().stream("GET", video_url, timeout=httpx.Timeout(300.0)) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(64 * 1024):
+                    if chunk:
+                        yield chunk
+        except HTTPError as exc:
+            raise RuntimeError(f"download failed: {exc}") from exc
+
+    async def _video_url(self, job_id: JobId) -> str:
+        status = await self.poll(job_id)
+        video_url = (status.extra or {}).get("video_url")
+        if status.status != "succeeded" or not video_url:
+            raise RuntimeError("download called before generation finished or without URL")
+        return video_url
+
 
 _default_provider = Veo3Provider()
@@ -3,17 +3,24 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import random
+from functools import lru_cache
 from pathlib import Path
-from typing import Callable, Union, Optional, Tuple
+from typing import AsyncIterator, Callable, Union, Optional, Tuple
+
+from config import settings
 
 from providers.base import JobId, JobStatus, Provider, VideoProvider
 from providers.models import GenerationParams
 from providers.luma_provider import LumaProvider
 from providers.veo3_provider import Veo3Provider
 from services.media_tools import (
-    enforce_ar_no_bars,     # 16:9 → cover+crop до 1920x1080 (без внутренних рамок)
-    build_vertical_blurpad, # 9:16 → вертикальный 1080x1920 канвас с блюр-подложкой
+    enforce_ar_no_bars_async,     # 16:9 → cover+crop до 1920x1080 (без внутренних рамок)
+    build_vertical_blurpad_async, # 9:16 → вертикальный 1080x1920 канвас с блюр-подложкой
+    normalize_stream,             # то же, но прямо из HTTP-потока (ffmpeg -i pipe:0)
+    warmup_encoder,               # детект H.264-энкодера вне event loop
 )
+from utils import http_pool
 
 log = logging.getLogger("services.generation_service")
 
@@ -23,17 +30,59 @@ _PROVIDER_FACTORIES: dict[Provider, Callable[[], VideoProvider]] = {
 }
 _provider_cache: dict[Provider, VideoProvider] = {}
 
+# job_id -> событие «есть новости по задаче» (будит wait_for_completion раньше таймера)
+_job_events: dict[JobId, asyncio.Event] = {}
+_MAX_POLL_INTERVAL_SEC = 30.0
+
 
 def get_provider(provider: Provider) -> VideoProvider:
     """Return a singleton provider instance for the requested backend."""
+    # горячий путь — один lookup в кэше
+    try:
+        return _provider_cache[provider]
+    except KeyError:
+        pass
+
     try:
         factory = _PROVIDER_FACTORIES[provider]
     except KeyError as exc:
         raise ValueError(f"Unsupported provider: {provider}") from exc
 
-    if provider not in _provider_cache:
-        _provider_cache[provider] = factory()
-    return _provider_cache[provider]
+    inst = factory()
+    _provider_cache[provider] = inst
+    return inst
+
+
+async def warmup() -> None:
+    """Прогрев на старте приложения: провайдеры (DNS/сессии — у кого есть warmup()) и детект энкодера."""
+    # инстансы создаём здесь, а не при импорте — первый create_job не платит за инициализацию,
+    # а импорт модуля (тесты, утилиты) не требует ключей и конфигурации провайдеров
+    providers: list[VideoProvider] = []
+    for provider in _PROVIDER_FACTORIES:
+        try:
+            providers.append(get_provider(provider))
+        except Exception as exc:
+            log.warning("Provider %s init failed: %s", provider.value, exc)
+    results = await asyncio.gather(
+        *(p.warmup() for p in providers if hasattr(p, "warmup")),
+        warmup_encoder(),
+        return_exceptions=True,
+    )
+    for res in results:
+        if isinstance(res, Exception):
+            log.warning("Provider warmup failed: %s", res)
+
+
+async def shutdown() -> None:
+    """Остановка приложения: закрываем общие HTTP-сессии провайдеров и пулы utils.http_pool."""
+    results = await asyncio.gather(
+        *(p.close() for p in _provider_cache.values() if hasattr(p, "close")),
+        http_pool.close_all(),
+        return_exceptions=True,
+    )
+    for res in results:
+        if isinstance(res, Exception):
+            log.warning("Provider shutdown failed: %s", res)
 
 
 async def create_job(params: GenerationParams) -> JobId:
@@ -52,6 +101,35 @@ async def download_job(provider: Provider, job_id: JobId) -> Path:
     return await get_provider(provider).download(job_id)
 
 
+def download_job_stream(provider: Provider, job_id: JobId) -> AsyncIterator[bytes]:
+    """Stream rendered asset bytes (providers with download_stream only)."""
+    return get_provider(provider).download_stream(job_id)
+
+
+def notify_job_update(job_id: JobId) -> bool:
+    """
+    Push-уведомление о задаче (например, из webhook-хендлера провайдера):
+    будит ожидающий wait_for_completion, чтобы он опросил статус немедленно.
+    Возвращает True, если кто-то ждал эту задачу.
+    """
+    woken = False
+    event = _job_events.get(job_id)
+    if event is not None:
+        event.set()
+        woken = True
+    for poller in _pollers.values():
+        woken = poller.wake(job_id) or woken
+    return woken
+
+
+def _retry_after(status: JobStatus) -> float:
+    """Retry-After из статуса провайдера (0, если не задан), не больше 4 максимальных пауз опроса."""
+    value = (status.extra or {}).get("retry_after")
+    if not isinstance(value, (int, float)):
+        return 0.0
+    return min(float(value), _MAX_POLL_INTERVAL_SEC * 4)
+
+
 async def wait_for_completion(
     provider: Provider,
     job_id: JobId,
@@ -60,47 +138,177 @@ async def wait_for_completion(
     timeout_sec: float = 20 * 60.0,
     max_retries: int = 3,
     interval_schedule: list[float] | None = None,
+    done_event: asyncio.Event | None = None,
 ) -> JobStatus:
     """
     Poll provider periodically until job completes or times out.
     Добавлен retry для временных сетевых ошибок.
+    Без interval_schedule пауза растёт экспоненциально (x1.5, потолок 30 с) с небольшим джиттером;
+    Retry-After провайдера (extra["retry_after"]) — нижняя граница паузы.
+    done_event (или notify_job_update) прерывает паузу и запускает опрос сразу.
     """
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
     deadline = loop.time() + timeout_sec
-    schedule = interval_schedule or [interval_sec]
+    schedule = interval_schedule
+    last_idx = len(schedule) - 1 if schedule else -1
     step = 0
+    event = done_event or asyncio.Event()
+    _job_events[job_id] = event
 
     attempt = 0
-    while True:
+    try:
+        while True:
+            try:
+                status = await poll_job(provider, job_id)
+            except Exception as exc:
+                attempt += 1
+                if attempt <= max_retries:
+                    backoff = min(5.0, interval_sec * attempt)
+                    if loop.time() + backoff > deadline:
+                        # ретрай всё равно не успеет до дедлайна — не ждём впустую
+                        log.error("poll_job failed and deadline is near, giving up: %s", exc)
+                        return JobStatus(status="failed", error=str(exc))
+                    log.warning(
+                        "poll_job failed (attempt %s/%s): %s. Retrying in %.1fs",
+                        attempt, max_retries, exc, backoff,
+                    )
+                    await asyncio.sleep(backoff)
+                    continue
+                log.error("poll_job failed permanently after %s retries: %s", max_retries, exc)
+                return JobStatus(status="failed", error=str(exc))
+
+            # сброс счётчика после успешного poll
+            attempt = 0
+
+            if status.status in {"succeeded", "failed"}:
+                return status
+
+            now = loop.time()
+            if now > deadline:
+                return JobStatus(status="failed", error="timeout")
+
+            if last_idx >= 0:
+                sleep_for = schedule[step if step < last_idx else last_idx]
+            else:
+                # показатель ограничен: 1.5 ** step на длинном таймауте переполнил бы float
+                sleep_for = min(interval_sec * 1.5 ** min(step, 16), max(_MAX_POLL_INTERVAL_SEC, interval_sec))
+                sleep_for += random.uniform(0, 0.1 * sleep_for)
+            sleep_for = max(sleep_for, _retry_after(status))
+            step += 1
+            try:
+                await asyncio.wait_for(event.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        if _job_events.get(job_id) is event:
+            del _job_events[job_id]
+
+
+class JobPoller:
+    """
+    Один фоновый опросчик на провайдера вместо отдельного цикла на каждую задачу.
+    Все ожидающие задачи опрашиваются в общем «тике» (пакетного эндпоинта у провайдеров нет —
+    внутри тика запросы идут конкурентно по каждому id), результат раздаётся через asyncio.Event.
+    Event loop однопоточный, поэтому блокировки не нужны.
+    """
+
+    def __init__(self, provider: Provider, *, interval_sec: float = 8.0, max_retries: int = 3) -> None:
+        self._provider = provider
+        self._interval = interval_sec
+        self._max_retries = max_retries
+        self._jobs: dict[JobId, asyncio.Event] = {}
+        self._status: dict[JobId, JobStatus] = {}
+        self._waiters: dict[JobId, int] = {}
+        self._errors: dict[JobId, int] = {}
+        self._intervals: dict[JobId, float] = {}
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    async def wait(
+        self,
+        job_id: JobId,
+        timeout_sec: float = 20 * 60.0,
+        *,
+        interval_sec: float | None = None,
+    ) -> JobStatus:
+        """
+        Дождаться финального статуса задачи (succeeded/failed) или таймаута.
+        interval_sec — желаемая пауза между опросами; тик идёт с минимальной из пауз ожидающих задач.
+        """
+        event = self._jobs.setdefault(job_id, asyncio.Event())
+        self._waiters[job_id] = self._waiters.get(job_id, 0) + 1
+        if interval_sec is not None:
+            self._intervals[job_id] = min(interval_sec, self._intervals.get(job_id, interval_sec))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name=f"job_poller:{self._provider.value}")
         try:
-            status = await poll_job(provider, job_id)
-        except Exception as exc:
-            attempt += 1
-            if attempt <= max_retries:
-                backoff = min(5.0, interval_sec * attempt)
-                log.warning(
-                    "poll_job failed (attempt %s/%s): %s. Retrying in %.1fs",
-                    attempt, max_retries, exc, backoff,
-                )
-                await asyncio.sleep(backoff)
+            await asyncio.wait_for(event.wait(), timeout=timeout_sec)
+            return self._status[job_id]
+        except asyncio.TimeoutError:
+            return JobStatus(status="failed", error="timeout")
+        finally:
+            self._waiters[job_id] -= 1
+            if self._waiters[job_id] <= 0:
+                for d in (self._jobs, self._status, self._waiters, self._errors, self._intervals):
+                    d.pop(job_id, None)
+
+    def wake(self, job_id: JobId) -> bool:
+        """Внеочередной тик (push-уведомление по задаче); True, если задача ожидается."""
+        if job_id not in self._jobs:
+            return False
+        self._wake.set()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            pending = [j for j, ev in self._jobs.items() if not ev.is_set()]
+            if not pending:
+                return
+            self._wake.clear()
+            results = await asyncio.gather(
+                *(poll_job(self._provider, j) for j in pending), return_exceptions=True
+            )
+            pause = min((self._intervals.get(j, self._interval) for j in pending), default=self._interval)
+            for job_id, res in zip(pending, results):
+                event = self._jobs.get(job_id)
+                if event is None:
+                    continue
+                if isinstance(res, BaseException):
+                    errors = self._errors.get(job_id, 0) + 1
+                    self._errors[job_id] = errors
+                    log.warning("poll_job failed for %s (attempt %s/%s): %s", job_id, errors, self._max_retries, res)
+                    if errors > self._max_retries:
+                        self._status[job_id] = JobStatus(status="failed", error=str(res))
+                        event.set()
+                    continue
+                self._errors.pop(job_id, None)
+                if res.status in {"succeeded", "failed"}:
+                    self._status[job_id] = res
+                    event.set()
+                else:
+                    pause = max(pause, _retry_after(res))
+            if all(ev.is_set() for ev in self._jobs.values()):
                 continue
-            log.error("poll_job failed permanently after %s retries: %s", max_retries, exc)
-            return JobStatus(status="failed", error=str(exc))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=pause)
+            except asyncio.TimeoutError:
+                pass
 
-        # сброс счётчика после успешного poll
-        attempt = 0
 
-        if status.status in {"succeeded", "failed"}:
-            return status
+_pollers: dict[Provider, JobPoller] = {}
 
-        if loop.time() > deadline:
-            return JobStatus(status="failed", error="timeout")
 
-        sleep_for = schedule[min(step, len(schedule) - 1)]
-        step += 1
-        await asyncio.sleep(sleep_for)
+def get_job_poller(provider: Provider) -> JobPoller:
+    """Общий JobPoller для провайдера (создаётся лениво)."""
+    try:
+        return _pollers[provider]
+    except KeyError:
+        poller = _pollers[provider] = JobPoller(provider)
+        return poller
 
 
+@lru_cache(maxsize=8)
 def _to_provider_enum(provider: Union[str, Provider]) -> Provider:
     return Provider(provider) if not isinstance(provider, Provider) else provider
 
@@ -274,11 +482,16 @@ async def create_video_pair(
 # ------------------------------
 # НОРМАЛИЗАЦИЯ ВЫХОДА
 # ------------------------------
-def _norm_out_path(src: Path, aspect: str) -> Path:
-    stem = src.stem
-    suffix = src.suffix or ".mp4"
+@lru_cache(maxsize=256)
+def _norm_out_name(src: str, aspect: str) -> str:
+    p = Path(src)
+    suffix = p.suffix or ".mp4"
     tag = "16x9" if aspect == "16:9" else "9x16" if aspect == "9:16" else aspect.replace(":", "x")
-    return src.with_name(f"{stem}.normalized_{tag}{suffix}")
+    return str(p.with_name(f"{p.stem}.normalized_{tag}{suffix}"))
+
+
+def _norm_out_path(src: Path, aspect: str) -> Path:
+    return Path(_norm_out_name(str(src), aspect))
 
 
 async def _normalize_to_aspect(src_path: Path, out_path: Path, aspect: str) -> None:
@@ -288,9 +501,9 @@ async def _normalize_to_aspect(src_path: Path, out_path: Path, aspect: str) -> N
     - 9:16 → вертикальный 1080x1920 канвас с блюр-подложкой
     """
     if aspect == "9:16":
-        await asyncio.to_thread(build_vertical_blurpad, str(src_path), str(out_path))
+        await build_vertical_blurpad_async(src_path, out_path)
     else:
-        await asyncio.to_thread(enforce_ar_no_bars, str(src_path), str(out_path), "16:9")
+        await enforce_ar_no_bars_async(src_path, out_path, "16:9")
 
 
 async def download_and_normalize_video(provider: str, job_id: JobId, aspect: str) -> Path:
@@ -301,11 +514,22 @@ async def download_and_normalize_video(provider: str, job_id: JobId, aspect: str
     Возвращает путь к нормализованному файлу.
     """
     provider_enum = _to_provider_enum(provider)
-    src_path = await download_job(provider_enum, job_id)
-    out_path = _norm_out_path(Path(src_path), aspect)
+    impl = get_provider(provider_enum)
+    if settings.NORMALIZE_FROM_STREAM and hasattr(impl, "download_stream"):
+        out_path = _norm_out_path(impl.download_target(job_id), aspect)
+        log.info("Normalizing AR to %s from stream: %s -> %s", aspect, job_id, out_path)
+        try:
+            await normalize_stream(download_job_stream(provider_enum, job_id), out_path, aspect)
+            return out_path
+        except RuntimeError as exc:
+            # например, moov в конце MP4 — из пайпа не читается; идём через файл
+            log.warning("Stream normalize failed, falling back to file download: %s", exc)
+
+    src_path = await download_job(provider_enum, job_id)  # провайдеры уже возвращают Path
+    out_path = _norm_out_path(src_path, aspect)
 
     log.info("Normalizing AR to %s (no bars/blurpad): %s -> %s", aspect, src_path, out_path)
-    await _normalize_to_aspect(Path(src_path), out_path, aspect)
+    await _normalize_to_aspect(src_path, out_path, aspect)
     return out_path
 
 
@@ -315,9 +539,10 @@ async def normalize_existing_video(src_path: Path, aspect: str) -> Path:
       - 16:9 → cover+crop 1920x1080,
       - 9:16 → вертикальный blurpad 1080x1920.
     """
-    out_path = _norm_out_path(Path(src_path), aspect)
-    log.info("Normalizing existing file to %s: %s -> %s", aspect, src_path, out_path)
-    await _normalize_to_aspect(Path(src_path), out_path, aspect)
+    src = src_path if isinstance(src_path, Path) else Path(src_path)
+    out_path = _norm_out_path(src, aspect)
+    log.info("Normalizing existing file to %s: %s -> %s", aspect, src, out_path)
+    await _normalize_to_aspect(src, out_path, aspect)
     return out_path
 
 
@@ -357,7 +582,7 @@ async def generate_wait_download_normalized(
         strict_ar=True,
     )
 
-    status = await wait_for_completion(Provider.VEO3, job_id, interval_sec=poll_interval, timeout_sec=poll_timeout)
+    status = await get_job_poller(Provider.VEO3).wait(job_id, poll_timeout, interval_sec=poll_interval)
     if status.status != "succeeded":
         raise RuntimeError(f"Generation failed: {status.error or {status.status}}")
 
@@ -409,20 +634,34 @@ async def generate_wait_download_normalized_pair(
         strict_ar=True,
     )
 
-    # ждём первый
-    st1 = await wait_for_completion(Provider.VEO3, job_id_first, interval_sec=poll_interval, timeout_sec=poll_timeout)
-    if st1.status != "succeeded":
-        raise RuntimeError(f"Original generation failed: {st1.error or st1.status}")
-    path1 = await download_and_normalize_video("veo3", job_id_first, aspect_ratio)
+    async def _finalize(job_id: JobId, label: str) -> Path:
+        # обе ветки ждут через общий JobPoller: Original и HQ опрашиваются в одном тике
+        st = await get_job_poller(Provider.VEO3).wait(job_id, poll_timeout, interval_sec=poll_interval)
+        if st.status != "succeeded":
+            raise RuntimeError(f"{label} generation failed: {st.error or st.status}")
+        return await download_and_normalize_video("veo3", job_id, aspect_ratio)
+
+    # оба прогона (ожидание → скачивание → ffmpeg) идут параллельно: latency = max(T1, T2)
+    leg1 = asyncio.create_task(_finalize(job_id_first, "Original"))
+    leg2 = asyncio.create_task(_finalize(job_id_hq, "HQ")) if job_id_hq else None
+
+    try:
+        path1 = await leg1
+    except BaseException:
+        # без оригинала HQ никому не нужен — не ждём его впустую
+        if leg2 is not None:
+            leg2.cancel()
+            # дожидаемся отмены: иначе ffmpeg/временные файлы HQ-ветки переживут вызов
+            await asyncio.gather(leg2, return_exceptions=True)
+        raise
 
     path2: Optional[Path] = None
-    if job_id_hq:
-        st2 = await wait_for_completion(Provider.VEO3, job_id_hq, interval_sec=poll_interval, timeout_sec=poll_timeout)
-        if st2.status != "succeeded":
-            log.error("HQ generation failed: %s", st2.error or st2.status)
+    if leg2 is not None:
+        try:
+            path2 = await leg2
+        except Exception as exc:
+            log.error("HQ generation failed: %s", exc)
             path2 = None
-        else:
-            path2 = await download_and_normalize_video("veo3", job_id_hq, aspect_ratio)
 
     return path1, path2
 
@@ -5,27 +5,57 @@ from __future__ import annotations
 services/media_tools.py
 
 Набор утилит для постпроцессинга видео:
+- probe_all: длительность, наличие аудио и параметры видео одним запуском ffprobe
 - probe_video: получить (width, height, fps) видео через ffprobe
 - probe_duration: получить длительность файла в секундах через ffprobe
+- probe_all_async / probe_video_async / probe_duration_async: то же самое без блокировки event loop
+  (все пробы — представления над одним кэшированным запуском ffprobe на файл)
+- probe_many: пробы пачки файлов параллельно (ограничено числом ядер)
 - build_intro_from_image: сделать короткий mp4 из картинки нужного размера (cover: без паддингов)
 - concat_two: склеить интро и основное видео без перехода (только видео)
 - concat_with_crossfade: склеить с плавным переходом (кроссфейд), сохранить аудио из второго клипа (если есть)
+- build_intro_and_concat: интро из картинки + склейка/кроссфейд за один запуск ffmpeg
 - enforce_ar_no_bars: нормализация без чёрных полос (включая «впаянные» letterbox)
 - build_vertical_blurpad: вертикальный 1080x1920 с размытой подложкой (как Reels/TikTok)
+  (у обеих есть *_async-варианты для event loop — без asyncio.to_thread)
+- normalize_stream: нормализация прямо из потока байт (ffmpeg -i pipe:0)
+
+Все функции с перекодированием принимают quality: "fast" (x264 -preset faster, по умолчанию)
+или "quality" (-preset slow); CRF один и тот же.
 """
 
 import asyncio
+import functools
 import json
 import os
 import shutil
 import subprocess
 import math
+import re
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import AsyncIterator, Literal, Tuple, Optional
+
+# PyAV (опционально): пробы прямо через libavformat, без запуска ffprobe
+try:
+    import av
+except ImportError:  # pragma: no cover - зависит от окружения
+    av = None
+
+# orjson (опционально): JSON ffprobe разбирается в разы быстрее stdlib json
+try:
+    import orjson
+    _loads = orjson.loads
+    _JSON_ERRORS: tuple[type[Exception], ...] = (orjson.JSONDecodeError, json.JSONDecodeError)
+except ImportError:  # pragma: no cover - зависит от окружения
+    _loads = json.loads
+    _JSON_ERRORS = (json.JSONDecodeError,)
 
 # -------- настройки качества (можно переопределить в .env) --------
 DEFAULT_CRF = int(os.getenv("VIDEO_CRF", "18"))
-DEFAULT_PRESET = os.getenv("FFMPEG_PRESET", "slow").strip() or "slow"
+# faster против slow — в ~3 раза меньше CPU на x264 при практически той же картинке на том же CRF
+# (качество держит CRF, preset — только скорость/размер). Качественный режим — quality="quality".
+DEFAULT_PRESET = os.getenv("FFMPEG_PRESET", "faster").strip() or "faster"
+QUALITY_PRESET = "slow"
 LOG_CMD = os.getenv("FFMPEG_LOG_CMD", "0") in ("1", "true", "True", "YES", "yes")
 
 # -------- утилиты --------
@@ -36,8 +66,8 @@ def _ratio_str(w: int, h: int) -> str:
 
 # -------- поиск бинарников --------
 def _ensure_path(p: str | Path) -> str:
-    """Преобразует путь к строке для ffmpeg/ffprobe (поддержка Path)."""
-    return str(Path(p))
+    """Преобразует путь к строке для ffmpeg/ffprobe (поддержка Path); str отдаётся как есть."""
+    return os.fspath(p)
 
 def _normalize_env_path(value: str | None, name: str) -> str | None:
     """
@@ -90,11 +120,159 @@ def _bin_path(name: str, env_var: str) -> str:
 
     return name  # даст шанс subprocess'у; в случае ошибки покажем понятный текст
 
+# Пути резолвим один раз при импорте (как и DEFAULT_CRF/DEFAULT_PRESET выше):
+# env/PATH за время жизни процесса не меняются, а команд на ролик — с десяток.
+_FFMPEG = _bin_path("ffmpeg", "FFMPEG_PATH")
+_FFPROBE = _bin_path("ffprobe", "FFPROBE_PATH")
+
+def reset_bin_cache() -> None:
+    """Перечитать FFMPEG_PATH/FFPROBE_PATH (для тестов и смены env на лету)."""
+    global _FFMPEG, _FFPROBE
+    _FFMPEG = _bin_path("ffmpeg", "FFMPEG_PATH")
+    _FFPROBE = _bin_path("ffprobe", "FFPROBE_PATH")
+    _detect_encoder.cache_clear()
+    _cuda_filters_available.cache_clear()
+
 def _ffprobe_path() -> str:
-    return _bin_path("ffprobe", "FFPROBE_PATH")
+    return _FFPROBE
 
 def _ffmpeg_path() -> str:
-    return _bin_path("ffmpeg", "FFMPEG_PATH")
+    return _FFMPEG
+
+# -------- выбор видеокодека (аппаратный H.264, если есть) --------
+# FFMPEG_ENCODER=auto — автодетект; либо явно: libx264 | h264_nvenc | h264_qsv | h264_videotoolbox
+_HW_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_videotoolbox")
+
+def _encoder_works(ffmpeg: str, encoder: str) -> bool:
+    """Энкодер может быть в списке сборки без реального железа — проверяем пробным кадром."""
+    cmd = [
+        ffmpeg, "-hide_banner", "-v", "error",
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.1",
+        "-frames:v", "1", "-c:v", encoder, "-f", "null", "-",
+    ]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15)
+    except (OSError, subprocess.SubprocessError):
+        return False
+    return proc.returncode == 0
+
+@functools.lru_cache(maxsize=1)
+def _detect_encoder() -> str:
+    """Один раз на процесс выбирает H.264-энкодер: nvenc → qsv → videotoolbox → libx264."""
+    choice = (os.getenv("FFMPEG_ENCODER") or "auto").strip().lower()
+    if choice != "auto":
+        return choice
+    ffmpeg = _ffmpeg_path()
+    try:
+        proc = subprocess.run(
+            [ffmpeg, "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=15,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return "libx264"
+    listed = set(proc.stdout.split())
+    for enc in _HW_ENCODERS:
+        if enc in listed and _encoder_works(ffmpeg, enc):
+            return enc
+    return "libx264"
+
+@functools.lru_cache(maxsize=1)
+def _cuda_filters_available() -> bool:
+    """CUDA-граф для blurpad: нужен рабочий nvenc, hwaccel cuda и фильтры scale_cuda/overlay_cuda."""
+    if _detect_encoder() != "h264_nvenc":
+        return False
+    ffmpeg = _ffmpeg_path()
+    try:
+        hwaccels = subprocess.run(
+            [ffmpeg, "-hide_banner", "-hwaccels"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=15,
+        ).stdout
+        filters = subprocess.run(
+            [ffmpeg, "-hide_banner", "-filters"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=15,
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return False
+    names = set(filters.split())
+    return "cuda" in hwaccels.split() and {"scale_cuda", "overlay_cuda"} <= names
+
+async def warmup_encoder() -> str:
+    """
+    Детект энкодера вне event loop (он гоняет ffmpeg синхронно, до нескольких секунд).
+    run_in_executor, а не to_thread: копия contextvars здесь не нужна.
+    """
+    if _detect_encoder.cache_info().currsize:
+        return _detect_encoder()
+    return await asyncio.get_running_loop().run_in_executor(None, _detect_encoder)
+
+Quality = Literal["fast", "quality"]
+
+# параметры качества аппаратных энкодеров — близко к визуальному уровню libx264 CRF 18;
+# (быстрый режим, качественный режим) — по аналогии с faster/slow у libx264
+_HW_ENCODER_ARGS: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {
+    "h264_nvenc": (
+        ("-preset", "p5", "-tune", "hq", "-rc", "vbr", "-cq", "19", "-b:v", "0"),
+        ("-preset", "p7", "-tune", "hq", "-rc", "vbr", "-cq", "19", "-b:v", "0"),
+    ),
+    "h264_qsv": (
+        ("-preset", "medium", "-global_quality", "19"),
+        ("-preset", "veryslow", "-global_quality", "19"),
+    ),
+    "h264_videotoolbox": (("-q:v", "50"), ("-q:v", "50")),
+}
+
+def _hw_encoder_args(enc: str, quality: Quality) -> Optional[tuple[str, ...]]:
+    modes = _HW_ENCODER_ARGS.get(enc)
+    if modes is None:
+        return None
+    return modes[1] if quality == "quality" else modes[0]
+
+def _video_codec_args(quality: Quality = "fast") -> list[str]:
+    """
+    Аргументы -c:v + параметры качества для выбранного энкодера (CRF/preset — только у libx264).
+    quality="fast" — DEFAULT_PRESET (faster), "quality" — QUALITY_PRESET (slow).
+    """
+    enc = _detect_encoder()
+    extra = _hw_encoder_args(enc, quality)
+    if extra is not None:
+        return ["-c:v", enc, *extra]
+    preset = QUALITY_PRESET if quality == "quality" else DEFAULT_PRESET
+    return ["-c:v", "libx264", "-crf", str(DEFAULT_CRF), "-preset", preset]
+
+# В stderr — только ошибки: без баннера и прогресса, пайп не раздувается
+_QUIET_ARGS = ("-hide_banner", "-nostats", "-loglevel", "error")
+
+def _movflags(fragmented: bool) -> tuple[str, ...]:
+    """
+    +faststart переписывает файл после кодирования (moov в начало) — лишний read+write всего ролика.
+    Фрагментированный MP4 пишется за один проход и сразу пригоден для стриминга (Telegram/web).
+    """
+    if fragmented:
+        return ("-movflags", "+frag_keyframe+empty_moov+default_base_moof")
+    return ("-movflags", "+faststart")
+
+def _ffmpeg_base() -> list[str]:
+    """Общий префикс всех команд кодирования/ремукса: бинарь, перезапись, тихий лог."""
+    return [_ffmpeg_path(), "-y", *_QUIET_ARGS]
+
+# Сколько ffmpeg кодируют одновременно (на весь процесс бота) и сколько потоков у каждого:
+# N параллельных энкодов по «все ядра» только толкаются в планировщике и раздувают RAM
+FFMPEG_CONCURRENCY = max(1, int(os.getenv("FFMPEG_CONCURRENCY") or (os.cpu_count() or 4) // 4))
+THREADS_PER_ENCODE = max(2, (os.cpu_count() or 4) // FFMPEG_CONCURRENCY)
+_ENCODE_SEM = asyncio.Semaphore(FFMPEG_CONCURRENCY)
+
+# Свою долю ядер — энкодеру и графам фильтров;
+# добавляется ко всем командам с кодированием (не к ремуксу/cropdetect)
+_THREAD_ARGS = (
+    "-threads", str(THREADS_PER_ENCODE),
+    "-filter_threads", str(THREADS_PER_ENCODE),
+    "-filter_complex_threads", str(THREADS_PER_ENCODE),
+)
+
+# Наши дескрипторы и так не наследуются (PEP 446), а close_fds=True выбивает CPython
+# с posix_spawn (vfork) на fork+exec — дорогой при большом RSS процесса бота.
+# Для posix_spawn нужен ещё путь с директорией — его даёт _bin_path.
+_SPAWN_KW = {"close_fds": False}
 
 # -------- внутренние синхронные helpers --------
 def _run_sync(cmd: list[str]) -> None:
@@ -102,120 +280,371 @@ def _run_sync(cmd: list[str]) -> None:
     if LOG_CMD:
         print("[ffmpeg] CMD:", " ".join(cmd))
     try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # stdout ffmpeg не нужен — не буферизуем его; stderr (с -loglevel error он крошечный)
+        # берём байтами и декодируем только при ошибке
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, **_SPAWN_KW)
+    except FileNotFoundError as e:
+        raise RuntimeError(
+            f"Executable not found: {cmd[0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
+        ) from e
+
+    _, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Command failed ({proc.returncode}): {' '.join(cmd)}\n{stderr.decode(errors='replace')}"
+        )
+
+def _run_capture_many(cmds: list[list[str]]) -> list[bytes]:
+    """
+    Несколько коротких команд (окна cropdetect) параллельно: все процессы стартуют сразу,
+    затем собираем их stderr (байтами, без декодирования) по порядку. Ошибка любого — RuntimeError.
+    """
+    procs: list[subprocess.Popen] = []
+    try:
+        for cmd in cmds:
+            if LOG_CMD:
+                print("[ffmpeg-capture] CMD:", " ".join(cmd))
+            procs.append(subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, **_SPAWN_KW))
+    except FileNotFoundError as e:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise RuntimeError(
+            f"Executable not found: {cmds[0][0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
+        ) from e
+
+    results = [(proc, proc.communicate()[1]) for proc in procs]
+    for proc, stderr in results:
+        if proc.returncode != 0:
+            raise RuntimeError(f"{cmds[0][0]} failed:\n{stderr.decode(errors='replace')}")
+    return [stderr for _, stderr in results]
+
+async def _communicate(proc: asyncio.subprocess.Process) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """
+    proc.communicate(), но отмена задачи (таймаут, отменённая генерация) убивает и ffmpeg —
+    иначе осиротевший процесс дожигает CPU до конца кодирования.
+    """
+    try:
+        return await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+
+async def _run_async(cmd: list[str]) -> None:
+    """
+    Асинхронный аналог _run_sync: процесс запускается прямо из event loop
+    (asyncio.create_subprocess_exec), без занятия потока из пула.
+    Одновременно — не больше FFMPEG_CONCURRENCY процессов (пробы/cropdetect идут мимо).
+    """
+    async with _ENCODE_SEM:
+        if LOG_CMD:
+            print("[ffmpeg-async] CMD:", " ".join(cmd))
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+        except FileNotFoundError as e:
+            raise RuntimeError(
+                f"Executable not found: {cmd[0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
+            ) from e
+
+        _, err = await _communicate(proc)
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Command failed ({proc.returncode}): {' '.join(cmd)}\n{err.decode(errors='replace')}"
+        )
+
+async def _run_capture_async(cmd: list[str]) -> bytes:
+    """Асинхронный запуск с захватом stderr (для cropdetect и т.п.); возвращает его байтами."""
+    if LOG_CMD:
+        print("[ffmpeg-capture-async] CMD:", " ".join(cmd))
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
     except FileNotFoundError as e:
         raise RuntimeError(
             f"Executable not found: {cmd[0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
         ) from e
 
+    _, err = await _communicate(proc)
     if proc.returncode != 0:
-        raise RuntimeError(f"Command failed ({proc.returncode}): {' '.join(cmd)}\n{proc.stderr}")
+        raise RuntimeError(f"{cmd[0]} failed:\n{err.decode(errors='replace')}")
+    return err
 
-def _run_capture(cmd: list[str]) -> subprocess.CompletedProcess:
-    """Запуск команды с возвратом stdout/stderr (для cropdetect и т.п.)."""
+async def _run_probe_async(cmd: list[str]) -> str:
+    """Асинхронный запуск ffprobe; возвращает stdout."""
     if LOG_CMD:
-        print("[ffmpeg-capture] CMD:", " ".join(cmd))
+        print("[ffprobe-async] CMD:", " ".join(cmd))
     try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
     except FileNotFoundError as e:
         raise RuntimeError(
             f"Executable not found: {cmd[0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
         ) from e
+
+    out, err = await _communicate(proc)
     if proc.returncode != 0:
-        raise RuntimeError(f"{cmd[0]} failed:\n{proc.stderr}")
-    return proc
+        raise RuntimeError(f"{cmd[0]} failed:\n{err.decode(errors='replace')}")
+    return out.decode(errors="replace")
+
+# сколько хвоста stderr ffprobe показываем в ошибке
+_PROBE_STDERR_MAX = 8192
 
 def _run_probe(cmd: list[str]) -> subprocess.CompletedProcess:
-    """Запускает команду probe (ffprobe)."""
+    """Запускает команду probe (ffprobe). stdout и stderr — байтами; stderr декодируется только при ошибке."""
     if LOG_CMD:
         print("[ffprobe] CMD:", " ".join(cmd))
     try:
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **_SPAWN_KW)
     except FileNotFoundError as e:
         raise RuntimeError(
             f"Executable not found: {cmd[0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
         ) from e
 
+    # -v error держит stderr крошечным — communicate() хватает, отдельный поток-дренажник не нужен
+    stdout, stderr = proc.communicate()
     if proc.returncode != 0:
-        raise RuntimeError(f"{cmd[0]} failed:\n{proc.stderr}")
-    return proc
+        tail = stderr[-_PROBE_STDERR_MAX:]
+        raise RuntimeError(f"{cmd[0]} failed:\n{tail.decode(errors='replace')}")
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
 
-# -------- вспомогательные проверки --------
-def _has_audio(path: str | Path) -> bool:
-    """True, если у файла есть хотя бы один аудиопоток."""
-    path = _ensure_path(path)
-    cmd = [
+# -------- ffprobe: один запуск на файл --------
+def _probe_all_cmd(path: str) -> list[str]:
+    # длительность контейнера + параметры всех потоков одним JSON: отдельные csv-пробы на
+    # duration/аудио дали бы лишние запуски ffprobe; json=c=1 — компактный вывод без отступов
+    return [
         _ffprobe_path(), "-v", "error",
-        "-select_streams", "a",
-        "-show_entries", "stream=index",
-        "-of", "json", path,
+        "-show_entries",
+        "format=duration:stream=index,codec_type,codec_name,width,height,"
+        "r_frame_rate,avg_frame_rate,sample_aspect_ratio,pix_fmt",
+        "-of", "json=c=1", path,
     ]
-    proc = _run_probe(cmd)
+
+def _parse_fps(fr: str, avg: str) -> float:
+    fr = fr if fr and fr != "0/0" else (avg or "25/1")
     try:
-        data = json.loads(proc.stdout or "{}")
-    except json.JSONDecodeError:
-        return False
-    streams = (data.get("streams") or [])
-    return len(streams) > 0
+        if "/" in fr:
+            num_s, den_s = fr.split("/", 1)
+            # ffprobe отдаёт целые «30000/1001» — int-парсинг дешевле float
+            try:
+                num, den = int(num_s), int(den_s)
+            except ValueError:
+                num, den = float(num_s), float(den_s)
+            return num / den if den else float(num)
+        return float(fr or 25.0)
+    except Exception:
+        return 25.0
 
-# -------- публичные утилиты --------
-def probe_video(path: str | Path) -> Tuple[int, int, float]:
-    """Возвращает (width, height, fps) первого видеопотока по ffprobe."""
-    path = _ensure_path(path)
-    cmd = [
-        _ffprobe_path(), "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height,r_frame_rate,avg_frame_rate",
-        "-of", "json", path,
-    ]
-    proc = _run_probe(cmd)
+def _parse_probe_all(stdout: str) -> dict:
+    """
+    JSON ffprobe → {"duration": float, "has_audio": bool,
+                    "video": {"width", "height", "fps", "codec", "sar", "pix_fmt"} | None}.
+    duration = 0.0, если контейнер её не сообщил.
+    """
     try:
-        data = json.loads(proc.stdout or "{}")
-    except json.JSONDecodeError as e:
+        data = _loads(stdout or "{}")
+    except _JSON_ERRORS as e:
         raise RuntimeError(f"ffprobe returned invalid JSON: {e}")
 
     streams = data.get("streams") or []
-    if not streams:
-        raise RuntimeError("No video stream found")
-    st = streams[0]
-    w = int(st.get("width") or 0)
-    h = int(st.get("height") or 0)
+    video = None
+    for st in streams:
+        if st.get("codec_type") == "video":
+            video = {
+                "width": int(st.get("width") or 0),
+                "height": int(st.get("height") or 0),
+                "fps": _parse_fps(st.get("r_frame_rate") or "", st.get("avg_frame_rate") or ""),
+                "codec": st.get("codec_name") or "",
+                "sar": st.get("sample_aspect_ratio") or "",
+                "pix_fmt": st.get("pix_fmt") or "",
+            }
+            break
+    try:
+        duration = float((data.get("format") or {}).get("duration") or 0.0)
+    except (TypeError, ValueError):
+        duration = 0.0
+    return {
+        "duration": duration,
+        "has_audio": any(st.get("codec_type") == "audio" for st in streams),
+        "video": video,
+    }
 
-    fr = st.get("r_frame_rate") or st.get("avg_frame_rate") or "25/1"
+def _probe_pyav(path: str) -> Optional[dict]:
+    """
+    То же, что _parse_probe_all, но через PyAV — микросекунды вместо fork+exec ffprobe.
+    None, если PyAV не установлен или не смог открыть файл (тогда работает ffprobe).
+    """
+    if av is None:
+        return None
     try:
-        if "/" in fr:
-            num_s, den_s = fr.split("/", 1)
-            num = float(num_s)
-            den = float(den_s) if float(den_s) != 0 else 1.0
-            fps = num / den
-        else:
-            fps = float(fr or 25.0)
+        with av.open(path) as container:
+            video = None
+            if container.streams.video:
+                st = container.streams.video[0]
+                cc = st.codec_context
+                rate = st.base_rate or st.average_rate  # как r_frame_rate → avg_frame_rate у ffprobe
+                sar = getattr(cc, "sample_aspect_ratio", None)
+                video = {
+                    "width": int(cc.width or 0),
+                    "height": int(cc.height or 0),
+                    "fps": float(rate) if rate else 25.0,
+                    "codec": cc.name or "",
+                    "sar": f"{sar.numerator}:{sar.denominator}" if sar is not None else "",
+                    "pix_fmt": cc.format.name if cc.format is not None else "",
+                }
+            duration = container.duration / av.time_base if container.duration else 0.0
+            return {
+                "duration": float(duration),
+                "has_audio": bool(container.streams.audio),
+                "video": video,
+            }
     except Exception:
-        fps = 25.0
+        return None
+
+# (абсолютный путь, mtime_ns, размер) → результат _parse_probe_all; общий для sync и async.
+# Перезаписанный файл получает новый ключ и пробуется заново. Значения не мутировать.
+_PROBE_CACHE_MAX = 256
+_probe_cache: dict[Tuple[str, int, int], dict] = {}
+
+def _stat_key(path: str) -> Optional[Tuple[str, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        # файла нет/недоступен (или его прямо сейчас пересоздают) — без кэша,
+        # пусть ffprobe вернёт понятную ошибку
+        return None
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+def _probe_cache_get(key: Optional[Tuple[str, int, int]]) -> Optional[dict]:
+    if key is None:
+        return None
+    info = _probe_cache.pop(key, None)
+    if info is not None:
+        _probe_cache[key] = info  # LRU: в конец
+    return info
+
+def _probe_cache_put(key: Optional[Tuple[str, int, int]], info: dict) -> None:
+    if key is None:
+        return
+    _probe_cache[key] = info
+    if len(_probe_cache) > _PROBE_CACHE_MAX:
+        del _probe_cache[next(iter(_probe_cache))]
+
+def _forget_probe(*paths: str) -> None:
+    """
+    Сбрасывает кэш проб для перезаписанных нами файлов. Ключ с mtime и так меняется,
+    но на ФС с грубым mtime перезапись того же размера в тот же тик дала бы устаревший результат.
+    """
+    stale = {os.path.abspath(p) for p in paths}
+    for key in [k for k in _probe_cache if k[0] in stale]:
+        del _probe_cache[key]
+
+def _probe_all(path: str | Path) -> dict:
+    """
+    Длительность, наличие аудио и параметры видео — одним ffprobe (или PyAV, если установлен),
+    с кэшем по (путь, mtime, размер).
+    """
+    src = _ensure_path(path)
+    key = _stat_key(src)
+    info = _probe_cache_get(key)
+    if info is None:
+        info = _probe_pyav(src) or _parse_probe_all(_run_probe(_probe_all_cmd(src)).stdout)
+        _probe_cache_put(key, info)
+    return info
+
+async def _probe_all_async(path: str | Path) -> dict:
+    """Асинхронный _probe_all (тот же кэш)."""
+    src = _ensure_path(path)
+    key = _stat_key(src)
+    info = _probe_cache_get(key)
+    if info is None:
+        if av is not None:
+            # av.open читает заголовок с диска — вне event loop
+            info = await asyncio.get_running_loop().run_in_executor(None, _probe_pyav, src)
+        if info is None:
+            info = _parse_probe_all(await _run_probe_async(_probe_all_cmd(src)))
+        _probe_cache_put(key, info)
+    return info
+
+async def probe_many(paths: list[str | Path], *, concurrency: int | None = None) -> list[dict]:
+    """
+    Пробы пачки файлов параллельно (как xargs -P): не больше concurrency ffprobe одновременно.
+    Результаты — в порядке paths, кэш общий с _probe_all.
+    """
+    sem = asyncio.Semaphore(max(1, concurrency or os.cpu_count() or 1))
+
+    async def one(p: str | Path) -> dict:
+        async with sem:
+            return await _probe_all_async(p)
 
+    return list(await asyncio.gather(*map(one, paths)))
+
+# -------- тонкие представления над _probe_all --------
+def _video_params(info: dict) -> Tuple[int, int, float]:
+    video = info["video"]
+    if not video:
+        raise RuntimeError("No video stream found")
+    w, h, fps = video["width"], video["height"], video["fps"]
     if w <= 0 or h <= 0:
         raise RuntimeError(f"Invalid probe result: width={w}, height={h}, fps={fps}")
     return w, h, fps
 
-def probe_duration(path: str | Path) -> float:
-    """Возвращает длительность файла (в секундах) по ffprobe."""
-    path = _ensure_path(path)
-    cmd = [
-        _ffprobe_path(), "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "json", path,
-    ]
-    proc = _run_probe(cmd)
-    try:
-        data = json.loads(proc.stdout or "{}")
-    except json.JSONDecodeError as e:
-        raise RuntimeError(f"ffprobe returned invalid JSON: {e}")
-
-    dur = float((data.get("format") or {}).get("duration") or 0.0)
+def _duration(info: dict) -> float:
+    dur = info["duration"]
     if dur <= 0:
         raise RuntimeError("Could not determine media duration")
     return dur
 
+def _has_audio(path: str | Path) -> bool:
+    """True, если у файла есть хотя бы один аудиопоток."""
+    return _probe_all(path)["has_audio"]
+
+async def _has_audio_async(path: str | Path) -> bool:
+    """Асинхронный вариант _has_audio."""
+    return (await _probe_all_async(path))["has_audio"]
+
+def _copy_info(info: dict) -> dict:
+    # наружу — копия: правка результата вызывающим не должна портить кэш
+    video = info["video"]
+    return {**info, "video": dict(video) if video else None}
+
+# -------- публичные утилиты --------
+def probe_all(path: str | Path) -> dict:
+    """
+    Всё, что нужно пайплайну, одним ffprobe (с кэшем по (путь, mtime, размер)):
+    {"duration": float, "has_audio": bool,
+     "video": {"width", "height", "fps", "codec", "sar", "pix_fmt"} | None}.
+    """
+    return _copy_info(_probe_all(path))
+
+async def probe_all_async(path: str | Path) -> dict:
+    """Асинхронный вариант probe_all."""
+    return _copy_info(await _probe_all_async(path))
+
+def probe_video(path: str | Path) -> Tuple[int, int, float]:
+    """
+    Возвращает (width, height, fps) первого видеопотока по ffprobe.
+    Результат кэшируется по (абсолютный путь, mtime, размер).
+    """
+    return _video_params(_probe_all(path))
+
+async def probe_video_async(path: str | Path) -> Tuple[int, int, float]:
+    """Асинхронный вариант probe_video (не блокирует event loop)."""
+    return _video_params(await _probe_all_async(path))
+
+def probe_duration(path: str | Path) -> float:
+    """Возвращает длительность файла (в секундах) по ffprobe."""
+    return _duration(_probe_all(path))
+
+async def probe_duration_async(path: str | Path) -> float:
+    """Асинхронный вариант probe_duration."""
+    return _duration(await _probe_all_async(path))
+
 async def build_intro_from_image(
     image_path: str | Path,
     out_path: str | Path,
@@ -224,11 +653,15 @@ async def build_intro_from_image(
     height: int,
     duration: float = 0.8,
     fps: float = 25.0,
+    fragmented: bool = False,
+    quality: Quality = "fast",
 ) -> None:
     """
     Короткий mp4 из картинки с cover-кропом под точные размеры (без паддингов).
     Фиксируем SAR/DAR, используем yuv420p.
+    Для «интро + видео» предпочтительнее build_intro_and_concat (один проход ffmpeg).
     """
+    await warmup_encoder()
     image_path = _ensure_path(image_path)
     out_path = _ensure_path(out_path)
     fps_i = max(1, int(round(fps)))
@@ -242,41 +675,118 @@ async def build_intro_from_image(
     )
 
     cmd = [
-        _ffmpeg_path(), "-y",
+        *_ffmpeg_base(),
         "-loop", "1",
         "-t", f"{max(0.05, float(duration))}",
         "-i", image_path,
         "-vf", vf,
         "-pix_fmt", "yuv420p",
-        "-c:v", "libx264",
-        "-crf", str(DEFAULT_CRF),
-        "-preset", DEFAULT_PRESET,
-        "-movflags", "+faststart",
+        *_video_codec_args(quality),
+        *_THREAD_ARGS,
+        *_movflags(fragmented),
         "-r", f"{fps_i}",
         out_path,
     ]
-    await asyncio.to_thread(_run_sync, cmd)
+    await _run_async(cmd)
+    _forget_probe(out_path)
+
+def _sar(video: dict) -> str:
+    # ffprobe отдаёт "0:1"/"N/A" (или ничего), если SAR не задан — декодер считает пиксель квадратным
+    sar = video.get("sar") or ""
+    return "1:1" if sar in ("", "0:1", "N/A") else sar
 
-async def concat_two(intro_path: str | Path, video_path: str | Path, out_path: str | Path) -> None:
-    """Склейка двух роликов без перехода (только видео)."""
+async def _same_stream_params(a: str, b: str) -> bool:
+    """
+    True, если ролики можно склеить без перекодирования: совпадают кодек, размер, fps и SAR,
+    и оба в yuv420p (иначе -c copy потерял бы гарантию re-encode-пути: yuv420p и setsar=1).
+    """
+    try:
+        info_a, info_b = await probe_many([a, b])
+    except Exception:
+        return False
+    va, vb = info_a["video"], info_b["video"]
+    if not va or not vb or not va["codec"]:
+        return False
+    return (
+        (va["width"], va["height"], va["codec"]) == (vb["width"], vb["height"], vb["codec"])
+        and abs(va["fps"] - vb["fps"]) < 0.01
+        and va["pix_fmt"] == vb["pix_fmt"] == "yuv420p"
+        and _sar(va) == _sar(vb)
+    )
+
+def _concat_list_line(path: str) -> str:
+    # экранирование одинарных кавычек по правилам concat demuxer
+    return "file '" + str(Path(path).resolve()).replace("'", "'\\''") + "'\n"
+
+async def concat_two(
+    intro_path: str | Path,
+    video_path: str | Path,
+    out_path: str | Path,
+    *,
+    allow_stream_copy: bool = True,
+    fragmented: bool = False,
+    quality: Quality = "fast",
+) -> None:
+    """
+    Склейка двух роликов без перехода (только видео).
+    Если кодек/размер/fps совпадают — склеиваем concat demuxer'ом с -c copy (без перекодирования).
+    """
     intro_path = _ensure_path(intro_path)
     video_path = _ensure_path(video_path)
     out_path = _ensure_path(out_path)
 
+    if allow_stream_copy and await _same_stream_params(intro_path, video_path):
+        list_path = Path(out_path).with_suffix(".concat.txt")
+        list_path.write_text(
+            _concat_list_line(intro_path) + _concat_list_line(video_path), encoding="utf-8"
+        )
+        cmd = [
+            *_ffmpeg_base(),
+            "-f", "concat", "-safe", "0",
+            "-i", str(list_path),
+            "-map", "0:v",
+            "-c", "copy",
+            "-an",
+            *_movflags(fragmented),
+            out_path,
+        ]
+        try:
+            await _run_async(cmd)
+        finally:
+            list_path.unlink(missing_ok=True)
+        _forget_probe(out_path)
+        return
+
+    await warmup_encoder()
     cmd = [
-        _ffmpeg_path(), "-y",
+        *_ffmpeg_base(),
         "-i", intro_path,
         "-i", video_path,
         "-filter_complex", "[0:v][1:v]concat=n=2:v=1:a=0[outv]",
         "-map", "[outv]",
         "-pix_fmt", "yuv420p",
-        "-c:v", "libx264",
-        "-crf", str(DEFAULT_CRF),
-        "-preset", DEFAULT_PRESET,
-        "-movflags", "+faststart",
+        *_video_codec_args(quality),
+        *_THREAD_ARGS,
+        *_movflags(fragmented),
         out_path,
     ]
-    await asyncio.to_thread(_run_sync, cmd)
+    await _run_async(cmd)
+    _forget_probe(out_path)
+
+@functools.lru_cache(maxsize=64)
+def _xfade_filter(intro_dur_ms: int, fd_ms: int, has_aud: bool) -> str:
+    """
+    filter_complex кроссфейда. Длительности квантованы до миллисекунд — типовые вызовы
+    (интро 0.8 с, fade 0.4 с) каждый раз дают одну и ту же строку из кэша.
+    """
+    offset_ms = max(0, intro_dur_ms - fd_ms)
+    video_chain = (
+        f"[0:v][1:v]xfade=transition=fade:duration={fd_ms / 1000}:offset={offset_ms / 1000},"
+        f"format=yuv420p[v]"
+    )
+    if not has_aud:
+        return video_chain
+    return f"{video_chain};[1:a]adelay={offset_ms}|{offset_ms}[a]"
 
 async def concat_with_crossfade(
     intro_path: str | Path,
@@ -284,94 +794,185 @@ async def concat_with_crossfade(
     out_path: str | Path,
     *,
     fade_duration: float = 0.4,
+    fragmented: bool = False,
+    quality: Quality = "fast",
 ) -> None:
-    """Склейка с кроссфейдом. Если у второго клипа есть звук — переносим его."""
+    """
+    Склейка с кроссфейдом. Если у второго клипа есть звук — переносим его.
+    Без звука и без места под переход (fade<=0 или интро не длиннее fade) — это просто concat_two.
+    """
     intro_path = _ensure_path(intro_path)
     video_path = _ensure_path(video_path)
     out_path = _ensure_path(out_path)
 
-    intro_dur = probe_duration(intro_path)
+    # по одному ffprobe на файл: длительность интро и аудио второго клипа из общего результата
+    (intro_info, video_info), _ = await asyncio.gather(
+        probe_many([intro_path, video_path]),
+        warmup_encoder(),
+    )
+    intro_dur = _duration(intro_info)
+    has_aud = video_info["has_audio"]
+    if not has_aud and (fade_duration <= 0 or intro_dur <= fade_duration):
+        await concat_two(intro_path, video_path, out_path, fragmented=fragmented, quality=quality)
+        return
     fd = max(0.1, float(fade_duration))
-    offset = max(0.0, intro_dur - fd)
-    has_aud = _has_audio(video_path)
-
-    video_chain = f"[0:v][1:v]xfade=transition=fade:duration={fd}:offset={offset},format=yuv420p[v]"
+    filter_complex = _xfade_filter(int(round(intro_dur * 1000)), int(round(fd * 1000)), has_aud)
 
     if has_aud:
-        adelay_ms = int(round(offset * 1000))
-        filter_complex = f"{video_chain};[1:a]adelay={adelay_ms}|{adelay_ms}[a]"
         cmd = [
-            _ffmpeg_path(), "-y",
+            *_ffmpeg_base(),
             "-i", intro_path, "-i", video_path,
             "-filter_complex", filter_complex,
             "-map", "[v]", "-map", "[a]",
-            "-c:v", "libx264",
-            "-crf", str(DEFAULT_CRF),
-            "-preset", DEFAULT_PRESET,
+            *_video_codec_args(quality),
+            *_THREAD_ARGS,
             "-pix_fmt", "yuv420p",
             "-c:a", "aac",
-            "-movflags", "+faststart",
+            *_movflags(fragmented),
             "-shortest",
             out_path,
         ]
     else:
         cmd = [
-            _ffmpeg_path(), "-y",
+            *_ffmpeg_base(),
             "-i", intro_path, "-i", video_path,
-            "-filter_complex", video_chain,
+            "-filter_complex", filter_complex,
             "-map", "[v]",
-            "-c:v", "libx264",
-            "-crf", str(DEFAULT_CRF),
-            "-preset", DEFAULT_PRESET,
+            *_video_codec_args(quality),
+            *_THREAD_ARGS,
             "-pix_fmt", "yuv420p",
-            "-movflags", "+faststart",
+            *_movflags(fragmented),
             "-shortest",
             out_path,
         ]
-    await asyncio.to_thread(_run_sync, cmd)
+    await _run_async(cmd)
+    _forget_probe(out_path)
+
+async def build_intro_and_concat(
+    image_path: str | Path,
+    video_path: str | Path,
+    out_path: str | Path,
+    *,
+    width: int,
+    height: int,
+    duration: float = 0.8,
+    fade: float = 0.0,
+    fps: float = 25.0,
+    fragmented: bool = False,
+    quality: Quality = "fast",
+) -> None:
+    """
+    Интро из картинки + основное видео за ОДИН запуск ffmpeg.
+    Картинка подаётся как -loop 1 -t, кадрирование/склейка (или кроссфейд при fade>0)
+    идут одним filter_complex: без промежуточного intro.mp4 и без повторного
+    кодирования интро. Заменяет цепочку build_intro_from_image + concat_two/concat_with_crossfade.
+    """
+    await warmup_encoder()
+    image_path = _ensure_path(image_path)
+    video_path = _ensure_path(video_path)
+    out_path = _ensure_path(out_path)
+    fps_i = max(1, int(round(fps)))
+    dar = _ratio_str(width, height)
+    intro_dur = max(0.05, float(duration))
+    fd = min(max(0.0, float(fade)), intro_dur)
+
+    cover = (
+        f"scale={width}:{height}:force_original_aspect_ratio=increase,"
+        f"crop={width}:{height},"
+        f"setsar=1,setdar={dar},"
+        f"fps={fps_i},format=yuv420p"
+    )
+    if fd > 0:
+        offset = max(0.0, intro_dur - fd)
+        join = f"[intro][main]xfade=transition=fade:duration={fd}:offset={offset},format=yuv420p[v]"
+    else:
+        offset = intro_dur
+        join = "[intro][main]concat=n=2:v=1:a=0,format=yuv420p[v]"
+    filter_complex = f"[0:v]{cover}[intro];[1:v]{cover}[main];{join}"
+
+    has_aud = await _has_audio_async(video_path)
+    maps = ["-map", "[v]"]
+    if has_aud:
+        adelay_ms = int(round(offset * 1000))
+        filter_complex += f";[1:a]adelay={adelay_ms}|{adelay_ms}[a]"
+        maps += ["-map", "[a]", "-c:a", "aac"]
+
+    cmd = [
+        *_ffmpeg_base(),
+        "-loop", "1",
+        "-t", f"{intro_dur}",
+        "-i", image_path,
+        "-i", video_path,
+        "-filter_complex", filter_complex,
+        *maps,
+        *_video_codec_args(quality),
+        *_THREAD_ARGS,
+        "-pix_fmt", "yuv420p",
+        *_movflags(fragmented),
+        out_path,
+    ]
+    await _run_async(cmd)
+    _forget_probe(out_path)
 
 # -------- анти-рамки (детект + удаление «впаянных» чёрных полос) --------
-def _parse_crop_from_stderr(stderr: str) -> Tuple[int, int, int, int] | None:
+_CROP_RE = re.compile(rb"crop=(\d+):(\d+):(\d+):(\d+)")
+
+def _parse_crop_from_stderr(stderr: bytes | str) -> Tuple[int, int, int, int] | None:
     """
     Парсит последнюю подсказку 'crop=w:h:x:y' из stderr ffmpeg (cropdetect).
     Возвращает (w, h, x, y) либо None.
     """
-    last = None
-    for line in (stderr or "").splitlines():
-        line = line.strip()
-        if "crop=" in line:
-            idx = line.rfind("crop=")
-            seg = line[idx + 5:].strip()
-            parts = seg.split(":")
-            if len(parts) >= 4:
-                try:
-                    cw = int(parts[0]); ch = int(parts[1]); cx = int(parts[2]); cy = int(parts[3])
-                    last = (cw, ch, cx, cy)
-                except Exception:
-                    pass
-    return last
-
-def _detect_letterbox_crop(src_path: str | Path, *, sample_frames: int = 120) -> Optional[Tuple[int, int, int, int]]:
-    """
-    Прогоняет cropdetect на первых N кадрах и возвращает подсказку (w,h,x,y),
-    если реально есть «впаянные» чёрные поля (>~2% площади).
-    """
-    src = _ensure_path(src_path)
-    iw, ih, _ = probe_video(src)
+    if isinstance(stderr, str):
+        stderr = stderr.encode("utf-8", "replace")
+    # один проход регэкспа по сырым байтам (на C): без декодирования и без списка всех совпадений
+    m = None
+    for m in _CROP_RE.finditer(stderr or b""):
+        pass
+    if m is None:
+        return None
+    cw, ch, cx, cy = m.groups()
+    return int(cw), int(ch), int(cx), int(cy)
 
+# cropdetect: вместо 120 кадров подряд — несколько коротких окон по ролику (seek по -ss)
+_CROP_SAMPLE_POINTS = (0.1, 0.5, 0.9)
+# cropdetect по умолчанию пропускает первые 2 кадра — берём с запасом
+_CROP_SAMPLE_FRAMES = 5
+
+def _cropdetect_cmd(src: str, start: float, frames: int) -> list[str]:
     # cropdetect логирует в stderr (info). limit=24 — порог чувствительности.
-    cmd = [
-        _ffmpeg_path(), "-hide_banner", "-v", "info",
+    cmd = [_ffmpeg_path(), "-hide_banner", "-v", "info"]
+    if start > 0:
+        cmd += ["-ss", f"{start:.3f}"]
+    cmd += [
         "-i", src,
         "-vf", "cropdetect=limit=24:round=2:reset=0",
-        "-frames:v", str(max(30, int(sample_frames))),
-        "-f", "null", "-"
+        "-frames:v", str(frames),
+        "-an", "-f", "null", "-",
     ]
-    proc = _run_capture(cmd)
-    hint = _parse_crop_from_stderr(proc.stderr or "")
-    if not hint:
+    return cmd
+
+def _cropdetect_windows(duration: float) -> list[Tuple[float, int]]:
+    """(старт, кадров) для каждого окна; короткие/без длительности ролики — одно окно с начала."""
+    if duration >= 1.0:
+        return [(duration * p, _CROP_SAMPLE_FRAMES) for p in _CROP_SAMPLE_POINTS]
+    return [(0.0, 30)]
+
+def _crop_hint(stderrs: list[bytes], iw: int, ih: int) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Подсказки cropdetect по окнам → общий прямоугольник (w,h,x,y), покрывающий контент всех окон,
+    если он реально срезает >~2% площади. Тёмные окна (затемнение, пустые подсказки) не сужают кроп.
+    """
+    boxes = []
+    for stderr in stderrs:
+        hint = _parse_crop_from_stderr(stderr)
+        if hint and hint[0] > 0 and hint[1] > 0:
+            boxes.append(hint)
+    if not boxes:
         return None
-    cw, ch, cx, cy = hint
+    cx = min(b[2] for b in boxes)
+    cy = min(b[3] for b in boxes)
+    cw = max(b[2] + b[0] for b in boxes) - cx
+    ch = max(b[3] + b[1] for b in boxes) - cy
 
     # подсказка почти равна исходнику — считаем, что полос нет
     area_ratio = (cw * ch) / float(iw * ih)
@@ -381,104 +982,357 @@ def _detect_letterbox_crop(src_path: str | Path, *, sample_frames: int = 120) ->
         return None
     return cw, ch, cx, cy
 
-def _even(val: int) -> int:
-    return val if val % 2 == 0 else val - 1
-
-def enforce_ar_no_bars(src_path: str | Path, dst_path: str | Path, aspect: str) -> None:
+def _detect_letterbox_crop(src_path: str | Path) -> Optional[Tuple[int, int, int, int]]:
     """
-    Нормализация кадра без рамок:
-      1) если внутри есть letterbox — предварительно вырежем его (cropdetect),
-      2) затем cover+crop к целевым размерам и фиксация DAR/SAR.
-    16:9 -> 1920x1080, DAR=16/9; 9:16 -> 1080x1920, DAR=9/16.
-    Аудио копируем как есть. Работает на любых сборках FFmpeg.
+    Прогоняет cropdetect на нескольких коротких окнах (10/50/90% длительности) и возвращает
+    подсказку (w,h,x,y), если реально есть «впаянные» чёрные поля (>~2% площади).
     """
     src = _ensure_path(src_path)
-    dst = _ensure_path(dst_path)
-    has_aud = _has_audio(src)
+    info = _probe_all(src)
+    iw, ih, _ = _video_params(info)
+    # окна независимы — декодируем их параллельно, encode-проход остаётся один
+    stderrs = _run_capture_many([
+        _cropdetect_cmd(src, start, frames)
+        for start, frames in _cropdetect_windows(info["duration"])
+    ])
+    return _crop_hint(stderrs, iw, ih)
+
+async def _detect_letterbox_crop_async(src_path: str | Path) -> Optional[Tuple[int, int, int, int]]:
+    """Асинхронный вариант _detect_letterbox_crop: окна cropdetect идут параллельно."""
+    src = _ensure_path(src_path)
+    info = await _probe_all_async(src)
+    iw, ih, _ = _video_params(info)
+    stderrs = await asyncio.gather(*(
+        _run_capture_async(_cropdetect_cmd(src, start, frames))
+        for start, frames in _cropdetect_windows(info["duration"])
+    ))
+    return _crop_hint(list(stderrs), iw, ih)
+
+def _even(val: int) -> int:
+    return val if val % 2 == 0 else val - 1
 
+def _target_frame(aspect: str) -> Tuple[int, int, str]:
+    """(width, height, DAR) целевого кадра для aspect."""
     if aspect == "9:16":
-        target_w, target_h = 1080, 1920
-        dar = "9/16"
-    else:
-        target_w, target_h = 1920, 1080
-        dar = "16/9"
+        return 1080, 1920, "9/16"
+    return 1920, 1080, "16/9"
+
+def _already_normalized(info: dict, aspect: str) -> bool:
+    """Исходник уже h264/yuv420p в целевом размере с квадратным пикселем — перекодировать нечего."""
+    video = info.get("video")
+    if not video:
+        return False
+    target_w, target_h, _ = _target_frame(aspect)
+    return (
+        (video["width"], video["height"]) == (target_w, target_h)
+        and video["codec"] == "h264"
+        and video["pix_fmt"] == "yuv420p"
+        and video["sar"] in ("1:1", "0:1", "")  # 0:1/пусто — SAR не задан, т.е. квадратный
+    )
+
+def _remux_cmd(src: str, dst: str, *, fragmented: bool = False) -> list[str]:
+    # без перекодирования: только перепаковка контейнера (+faststart или fMP4)
+    return [
+        *_ffmpeg_base(),
+        "-i", src,
+        "-map", "0:v:0", "-map", "0:a?",
+        "-c", "copy",
+        *_movflags(fragmented),
+        dst,
+    ]
+
+def _enforce_ar_vf(aspect: str, hint: Optional[Tuple[int, int, int, int]]) -> str:
+    target_w, target_h, dar = _target_frame(aspect)
 
     # 1) авто-кроп «впаянных» полос (если есть)
     pre_crop = ""
-    try:
-        hint = _detect_letterbox_crop(src)
-    except Exception:
-        hint = None
     if hint:
         cw, ch, cx, cy = hint
         pre_crop = f"crop={cw}:{ch}:{cx}:{cy},"
 
     # 2) нормализация под целевой AR
-    vf = (
+    return (
         f"{pre_crop}"
         f"scale={target_w}:{target_h}:force_original_aspect_ratio=increase,"
         f"crop={target_w}:{target_h},"
         f"setsar=1,setdar={dar},format=yuv420p"
     )
 
+def _enforce_ar_cmd(
+    src: str,
+    dst: str,
+    aspect: str,
+    *,
+    has_aud: bool,
+    hint: Optional[Tuple[int, int, int, int]],
+    fragmented: bool = False,
+    quality: Quality = "fast",
+) -> list[str]:
     cmd = [
-        _ffmpeg_path(), "-y",
+        *_ffmpeg_base(),
         "-i", src,
-        "-vf", vf,
-        "-c:v", "libx264",
-        "-crf", str(DEFAULT_CRF),
-        "-preset", DEFAULT_PRESET,
+        "-vf", _enforce_ar_vf(aspect, hint),
+        *_video_codec_args(quality),
+        *_THREAD_ARGS,
         "-pix_fmt", "yuv420p",
-        "-movflags", "+faststart",
+        *_movflags(fragmented),
     ]
     if has_aud:
         cmd += ["-c:a", "copy"]
     else:
         cmd += ["-an"]
     cmd += [dst]
-    _run_sync(cmd)
+    return cmd
 
-def build_vertical_blurpad(src_path: str | Path, dst_path: str | Path) -> None:
+def _normalize_plan(src: str, aspect: str) -> Tuple[bool, Optional[Tuple[int, int, int, int]], bool]:
     """
-    Формирует вертикальный ролик 1080x1920 с размытым фоном (TikTok/Reels style).
-    Перед тем, как собирать фон/фореграунд, вырезает «впаянные» чёрные полосы (cropdetect).
+    (есть аудио, crop-подсказка, хватит ли ремукса) для нормализаторов:
+    исходник уже в целевом кадре и без «впаянных» полос — перекодировать нечего.
     """
-    src = _ensure_path(src_path)
-    dst = _ensure_path(dst_path)
     has_aud = _has_audio(src)
-
-    crop_stage = ""
     try:
         hint = _detect_letterbox_crop(src)
     except Exception:
         hint = None
+    try:
+        remux = hint is None and _already_normalized(_probe_all(src), aspect)
+    except Exception:
+        remux = False
+    return has_aud, hint, remux
+
+async def _normalize_plan_async(src: str, aspect: str) -> Tuple[bool, Optional[Tuple[int, int, int, int]], bool]:
+    """Асинхронный _normalize_plan."""
+    has_aud = await _has_audio_async(src)
+    try:
+        hint = await _detect_letterbox_crop_async(src)
+    except Exception:
+        hint = None
+    try:
+        remux = hint is None and _already_normalized(await _probe_all_async(src), aspect)
+    except Exception:
+        remux = False
+    return has_aud, hint, remux
+
+def enforce_ar_no_bars(
+    src_path: str | Path, dst_path: str | Path, aspect: str, *,
+    fragmented: bool = False, quality: Quality = "fast",
+) -> None:
+    """
+    Нормализация кадра без рамок:
+      1) если внутри есть letterbox — предварительно вырежем его (cropdetect),
+      2) затем cover+crop к целевым размерам и фиксация DAR/SAR.
+    16:9 -> 1920x1080, DAR=16/9; 9:16 -> 1080x1920, DAR=9/16.
+    Аудио копируем как есть. Работает на любых сборках FFmpeg.
+    Если исходник уже h264/yuv420p нужного размера без полос — только ремукс (-c copy).
+    """
+    src = _ensure_path(src_path)
+    dst = _ensure_path(dst_path)
+    has_aud, hint, remux = _normalize_plan(src, aspect)
+    if remux:
+        _run_sync(_remux_cmd(src, dst, fragmented=fragmented))
+    else:
+        _run_sync(_enforce_ar_cmd(
+            src, dst, aspect, has_aud=has_aud, hint=hint, fragmented=fragmented, quality=quality,
+        ))
+    _forget_probe(dst)
+
+async def enforce_ar_no_bars_async(
+    src_path: str | Path, dst_path: str | Path, aspect: str, *,
+    fragmented: bool = False, quality: Quality = "fast",
+) -> None:
+    """Асинхронный enforce_ar_no_bars: ffprobe/ffmpeg запускаются из event loop, без пула потоков."""
+    src = _ensure_path(src_path)
+    dst = _ensure_path(dst_path)
+    (has_aud, hint, remux), _ = await asyncio.gather(_normalize_plan_async(src, aspect), warmup_encoder())
+    if remux:
+        await _run_async(_remux_cmd(src, dst, fragmented=fragmented))
+    else:
+        await _run_async(
+            _enforce_ar_cmd(
+                src, dst, aspect, has_aud=has_aud, hint=hint, fragmented=fragmented, quality=quality,
+            )
+        )
+    _forget_probe(dst)
+
+# больше входов в одном ffmpeg — больше одновременно живых декодеров/lookahead x264 в памяти
+# фон blurpad: размываем на 1/4 разрешения и растягиваем обратно — в 16 раз меньше работы для boxblur,
+# после апскейла визуально не отличить от boxblur=20:1 на полном 1080x1920
+_BLURPAD_BG_VF = "scale=270:480,boxblur=6:1,scale=1080:1920:flags=bilinear"
+
+
+def _blurpad_cmd(
+    src: str,
+    dst: str,
+    *,
+    has_aud: bool,
+    hint: Optional[Tuple[int, int, int, int]],
+    cuda: bool = False,
+    fragmented: bool = False,
+    quality: Quality = "fast",
+) -> list[str]:
+    crop_stage = ""
     if hint:
         cw, ch, cx, cy = hint
         crop_stage = f"crop={cw}:{ch}:{cx}:{cy},"
 
-    filter_complex = (
-        f"[0:v]{crop_stage}scale=1080:1920,boxblur=20:1[bg];"
-        f"[0:v]{crop_stage}scale=-2:1920[fg];"
-        f"[bg][fg]overlay=(W-w)/2:(H-h)/2,setsar=1,setdar=9/16,format=yuv420p[vout]"
-    )
+    if cuda:
+        # всё на GPU: boxblur_cuda в ffmpeg нет — размываем даунскейлом 1/8 и бикубическим апскейлом,
+        # кадры из overlay_cuda идут прямо в h264_nvenc без hwdownload
+        filter_complex = (
+            f"[0:v]{crop_stage}format=yuv420p,hwupload_cuda,split=2[bgu][fgu];"
+            f"[bgu]scale_cuda=136:240,scale_cuda=1080:1920:interp_algo=bicubic[bg];"
+            f"[fgu]scale_cuda=-2:1920[fg];"
+            f"[bg][fg]overlay_cuda=x=(main_w-overlay_w)/2:y=(main_h-overlay_h)/2,"
+            f"setsar=1,setdar=9/16[vout]"
+        )
+        codec = ["-c:v", "h264_nvenc", *_hw_encoder_args("h264_nvenc", quality)]
+    else:
+        filter_complex = (
+            f"[0:v]{crop_stage}{_BLURPAD_BG_VF}[bg];"
+            f"[0:v]{crop_stage}scale=-2:1920[fg];"
+            f"[bg][fg]overlay=(W-w)/2:(H-h)/2,setsar=1,setdar=9/16,format=yuv420p[vout]"
+        )
+        codec = [
+            *_video_codec_args(quality),
+            "-pix_fmt", "yuv420p",
+        ]
 
     cmd = [
-        _ffmpeg_path(), "-y",
+        *_ffmpeg_base(),
         "-i", src,
         "-filter_complex", filter_complex,
         "-map", "[vout]",
-        "-c:v", "libx264",
-        "-crf", str(DEFAULT_CRF),
-        "-preset", DEFAULT_PRESET,
-        "-pix_fmt", "yuv420p",
-        "-movflags", "+faststart",
+        *codec,
+        *_THREAD_ARGS,
+        *_movflags(fragmented),
     ]
     if has_aud:
         cmd += ["-map", "0:a?", "-c:a", "copy"]
     else:
         cmd += ["-an"]
     cmd += [dst]
-    _run_sync(cmd)
+    return cmd
+
+HwMode = Literal["auto", "cpu", "cuda"]
+
+def build_vertical_blurpad(
+    src_path: str | Path, dst_path: str | Path, *, hw: HwMode = "auto",
+    fragmented: bool = False, quality: Quality = "fast",
+) -> None:
+    """
+    Формирует вертикальный ролик 1080x1920 с размытым фоном (TikTok/Reels style).
+    Перед тем, как собирать фон/фореграунд, вырезает «впаянные» чёрные полосы (cropdetect).
+    hw: "cuda" — фильтры и энкод на GPU, "cpu" — классический граф,
+    "auto" — CUDA, если она реально доступна (при ошибке GPU-прогона — повтор на CPU).
+    Исходник уже 1080x1920 h264/yuv420p без полос — только ремукс (-c copy).
+    """
+    src = _ensure_path(src_path)
+    dst = _ensure_path(dst_path)
+    has_aud, hint, remux = _normalize_plan(src, "9:16")
+    try:
+        if remux:
+            _run_sync(_remux_cmd(src, dst, fragmented=fragmented))
+            return
+        if hw == "cuda" or (hw == "auto" and _cuda_filters_available()):
+            try:
+                _run_sync(_blurpad_cmd(
+                    src, dst, has_aud=has_aud, hint=hint, cuda=True, fragmented=fragmented, quality=quality,
+                ))
+                return
+            except RuntimeError:
+                if hw == "cuda":
+                    raise
+        _run_sync(_blurpad_cmd(
+            src, dst, has_aud=has_aud, hint=hint, fragmented=fragmented, quality=quality,
+        ))
+    finally:
+        _forget_probe(dst)
+
+async def build_vertical_blurpad_async(
+    src_path: str | Path, dst_path: str | Path, *, hw: HwMode = "auto",
+    fragmented: bool = False, quality: Quality = "fast",
+) -> None:
+    """Асинхронный build_vertical_blurpad (без пула потоков)."""
+    src = _ensure_path(src_path)
+    dst = _ensure_path(dst_path)
+    (has_aud, hint, remux), _ = await asyncio.gather(_normalize_plan_async(src, "9:16"), warmup_encoder())
+    if remux:
+        try:
+            await _run_async(_remux_cmd(src, dst, fragmented=fragmented))
+        finally:
+            _forget_probe(dst)
+        return
+    if hw == "auto":
+        use_cuda = await asyncio.get_running_loop().run_in_executor(None, _cuda_filters_available)
+    else:
+        use_cuda = hw == "cuda"
+    try:
+        if use_cuda:
+            try:
+                await _run_async(
+                    _blurpad_cmd(
+                        src, dst, has_aud=has_aud, hint=hint, cuda=True, fragmented=fragmented, quality=quality,
+                    )
+                )
+                return
+            except RuntimeError:
+                if hw == "cuda":
+                    raise
+        await _run_async(_blurpad_cmd(
+            src, dst, has_aud=has_aud, hint=hint, fragmented=fragmented, quality=quality,
+        ))
+    finally:
+        _forget_probe(dst)
+
+async def normalize_stream(chunks: AsyncIterator[bytes], dst_path: str | Path, aspect: str) -> None:
+    """
+    Нормализация прямо из потока байт (ffmpeg -i pipe:0), без промежуточного файла.
+    Пробы по пайпу недоступны: cropdetect пропускаем, аудио маппим опционально.
+    MP4 из пайпа читается, только если moov в начале файла — иначе RuntimeError.
+    """
+    dst = _ensure_path(dst_path)
+    await warmup_encoder()
+    if aspect == "9:16":
+        cmd = _blurpad_cmd("pipe:0", dst, has_aud=True, hint=None)
+    else:
+        cmd = _enforce_ar_cmd("pipe:0", dst, "16:9", has_aud=True, hint=None)
+    async with _ENCODE_SEM:
+        rc, stderr = await _run_stream(cmd, chunks)
+    _forget_probe(dst)
+    if rc != 0:
+        raise RuntimeError(f"Command failed ({rc}): {' '.join(cmd)}\n{stderr.decode(errors='replace')}")
+
+async def _run_stream(cmd: list[str], chunks: AsyncIterator[bytes]) -> Tuple[int, bytes]:
+    """Кормит stdin процесса чанками; возвращает (код возврата, stderr)."""
+    if LOG_CMD:
+        print("[ffmpeg-stream] CMD:", " ".join(cmd))
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError as e:
+        raise RuntimeError(
+            f"Executable not found: {cmd[0]}\nПроверь .env (FFMPEG_PATH/FFPROBE_PATH) и доступность файла."
+        ) from e
+    # stderr читаем параллельно, иначе ffmpeg может встать на полном пайпе
+    err_task = asyncio.create_task(proc.stderr.read())
+    try:
+        async for chunk in chunks:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg упал раньше — причина будет в stderr
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdin.close()
+        rc = await proc.wait()
+        stderr = await err_task
+    return rc, stderr
 
 # --- mini tmp cleanup (startup + on-exit) ---
 import atexit, time, tempfile
@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 # Итерация A: простая заглушка модерации (позже: словари + скоринг)
+import re
 
 
 BLACKLIST = {"порно", "насилие"}
 GREYLIST = {"эротика", "жестокость"}
 
 
+def _compile(words: set[str]) -> re.Pattern[str]:
+    # один регэксп на список: строка сканируется один раз на C, без .lower() и цикла по словам
+    return re.compile("|".join(map(re.escape, sorted(words))), re.IGNORECASE)
+
+
+_BLACK_RE = _compile(BLACKLIST)
+_GREY_RE = _compile(GREYLIST)
+
+
 class ModResult:
     def __init__(self, allow: bool, soft: bool = False, reason: str = ""):
         self.allow = allow
@@ -16,10 +26,9 @@ class ModResult:
 
 
 def check_text(prompt: str) -> ModResult:
-    p = prompt.lower()
-    if any(word in p for word in BLACKLIST):
+    if _BLACK_RE.search(prompt):
         return ModResult(False, False, "hard-block: blacklist match")
-    if any(word in p for word in GREYLIST):
+    if _GREY_RE.search(prompt):
         return ModResult(True, True, "soft-block: greylist match")
     if len(prompt) < 5:
         return ModResult(False, False, "prompt too short")
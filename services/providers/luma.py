@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 # services/providers/luma.py
 import os
+import random
 import time
 import asyncio
+import warnings
+from typing import Optional
 import logging
 import aiohttp
 
+from providers.base import LRUCache, json_loads, parse_retry_after
+from utils.http_pool import lease
+
 log = logging.getLogger(__name__)
 
 BASE = "https://api.lumalabs.ai/dream-machine/v1"
@@ -21,9 +27,35 @@ HEADERS_GET = {
     "Accept": "application/json",
 }
 
+class LumaHTTPError(RuntimeError):
+    """Ошибка HTTP от Luma: статус и Retry-After (секунды или None) для решения о повторе."""
+
+    def __init__(self, message: str, status: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
 def _raise_http(name: str, r: aiohttp.ClientResponse, body_text: str):
     # единый формат ошибки, чтобы в логах было видно статус и полный текст тела
-    raise RuntimeError(f"{name} failed {r.status}. Body: {body_text}")
+    raise LumaHTTPError(
+        f"{name} failed {r.status}. Body: {body_text}",
+        r.status,
+        parse_retry_after(r.headers.get("Retry-After")),
+    )
+
+def _json_body(name: str, url: str, r: aiohttp.ClientResponse, body: bytes) -> dict:
+    """Тело ответа, прочитанное один раз: в текст — только для ошибки, иначе сразу JSON."""
+    if r.status >= 400:
+        text = body.decode("utf-8", "replace")
+        log.error("%s %s failed %s\nBody: %s", name, url, r.status, text)
+        _raise_http(name, r, text)
+    try:
+        return json_loads(body)
+    except ValueError:
+        text = body.decode("utf-8", "replace")
+        log.error("%s %s non-json response: %s", name, url, text)
+        raise RuntimeError(f"{name} non-json response. Body: {text}")
 
 async def submit(prompt: str, aspect: str, speed: str, *, model: str = "ray-2"):
     """
@@ -37,17 +69,10 @@ async def submit(prompt: str, aspect: str, speed: str, *, model: str = "ray-2"):
         "aspect_ratio": aspect,    # "16:9" | "9:16"
         # опционально: "resolution": "720p", "duration": "5s"
     }
-    async with aiohttp.ClientSession(trust_env=True) as s:
-        async with s.post(url, headers=HEADERS_JSON, json=payload) as r:
-            text = await r.text()
-            if r.status >= 400:
-                log.error("Luma POST %s failed %s\nBody: %s", url, r.status, text)
-                _raise_http("Luma POST", r, text)
-            try:
-                data = await r.json()
-            except Exception:
-                log.error("Luma POST %s non-json response: %s", url, text)
-                raise RuntimeError(f"Luma POST non-json response. Body: {text}")
+    # общая сессия пула: TLS-соединение переиспользуется между сабмитами и опросами
+    async with lease(BASE) as s, s.post(url, headers=HEADERS_JSON, json=payload) as r:
+        body = await r.read()
+    data = _json_body("Luma POST", url, r, body)
 
     gen_id = data.get("id") or (data.get("generation") or {}).get("id")
     if not gen_id:
@@ -55,36 +80,95 @@ async def submit(prompt: str, aspect: str, speed: str, *, model: str = "ray-2"):
         raise RuntimeError(f"Luma POST ok but no id. Body: {data}")
     return {"job_id": gen_id, "raw": data}
 
+# job_id -> (ETag, последний ответ): пока генерация не изменилась, GET идёт с If-None-Match
+_poll_etags: LRUCache = LRUCache(256)
+
+
 async def poll(job_id: str):
     """
     GET /dream-machine/v1/generations/{id}
     ожидаем { state: ..., assets: { video: url } }
     """
     url = f"{BASE}/generations/{job_id}"
-    async with aiohttp.ClientSession(trust_env=True) as s:
-        async with s.get(url, headers=HEADERS_GET) as r:
-            text = await r.text()
-            if r.status >= 400:
-                log.error("Luma GET %s failed %s\nBody: %s", url, r.status, text)
-                _raise_http("Luma GET", r, text)
-            try:
-                data = await r.json()
-            except Exception:
-                log.error("Luma GET %s non-json response: %s", url, text)
-                raise RuntimeError(f"Luma GET non-json response. Body: {text}")
+    headers = HEADERS_GET
+    cached = _poll_etags.get(job_id)
+    if cached:
+        headers = {**HEADERS_GET, "If-None-Match": cached[0]}
+    async with lease(BASE) as s, s.get(url, headers=headers) as r:
+        body = await r.read()
+    if r.status == 304 and cached:
+        # генерация не изменилась — тело не пришло, отдаём прошлый ответ
+        data = cached[1]
+    else:
+        data = _json_body("Luma GET", url, r, body)
+        etag = r.headers.get("ETag")
+        if etag:
+            _poll_etags[job_id] = (etag, data)
 
     state = data.get("state")
+    if state in {"completed", "succeeded", "failed", "error"}:
+        _poll_etags.pop(job_id, None)
     video_url = (data.get("assets") or {}).get("video")
     return {"status": state, "video_url": video_url, "raw": data}
 
-async def wait_until_complete(job_id: str, *, interval_sec: int = 8, timeout_sec: int = 20 * 60):
+# пауза между опросами: 2 с, x1.5 за опрос, не больше 15 с
+_POLL_INITIAL_SEC = 2.0
+_POLL_BACKOFF = 1.5
+_POLL_MAX_SEC = 15.0
+# подряд идущих временных ошибок (сеть, 429, 5xx), после которых сдаёмся
+_POLL_MAX_ERRORS = 3
+_RETRY_AFTER_MAX_SEC = 60.0
+
+
+async def wait_until_complete(
+    job_id: str,
+    *,
+    max_interval_sec: float = _POLL_MAX_SEC,
+    timeout_sec: int = 20 * 60,
+    interval_sec: Optional[float] = None,
+):
+    """
+    Опрашивает генерацию до финала с растущей паузой (2 с → max_interval_sec).
+    На 429 ждёт Retry-After; временные сетевые ошибки и 5xx повторяет с джиттером.
+    interval_sec — устаревшее имя (раньше — фиксированная пауза), теперь задаёт потолок паузы.
+    """
+    if interval_sec is not None:
+        warnings.warn(
+            "wait_until_complete(interval_sec=...) устарел, используйте max_interval_sec",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        max_interval_sec = interval_sec
     start = time.monotonic()
     last_state = None
+    delay = _POLL_INITIAL_SEC
+    errors = 0
     while True:
-        info = await poll(job_id)
+        try:
+            info = await poll(job_id)
+        except (LumaHTTPError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status = getattr(e, "status", None)
+            if status is not None and status != 429 and status < 500:
+                raise
+            errors += 1
+            if errors > _POLL_MAX_ERRORS or time.monotonic() - start > timeout_sec:
+                raise
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None:
+                # раньше Retry-After нельзя — джиттер только вверх
+                pause = min(retry_after, _RETRY_AFTER_MAX_SEC) + random.uniform(0, 1.0)
+            else:
+                pause = delay * random.uniform(0.8, 1.2)
+            log.warning("Luma poll %s failed (%s/%s): %s; retry in %.1fs", job_id, errors, _POLL_MAX_ERRORS, e, pause)
+            await asyncio.sleep(pause)
+            continue
+        errors = 0
         state = info.get("status")
         if state != last_state:
             log.info("Luma job %s state -> %s", job_id, state)
+            # генерация стартовала («dreaming») — паузы растут заново от 2 с
+            if state == "dreaming":
+                delay = _POLL_INITIAL_SEC
             last_state = state
 
         if state in {"completed", "succeeded"} and info.get("video_url"):
@@ -95,11 +179,15 @@ async def wait_until_complete(job_id: str, *, interval_sec: int = 8, timeout_sec
         if time.monotonic() - start > timeout_sec:
             return {"final": "timeout", "raw": info.get("raw")}
 
-        await asyncio.sleep(interval_sec)
+        await asyncio.sleep(delay)
+        delay = min(max_interval_sec, max(_POLL_INITIAL_SEC, delay * _POLL_BACKOFF))
 
 async def download_video(url: str) -> bytes:
-    async with aiohttp.ClientSession(trust_env=True) as s:
-        async with s.get(url) as r:
+    # CDN с роликами — отдельный хост, у него свой пул соединений
+    # lease: сессию не закроет чистка простоя, пока ролик ещё качается
+    async with lease(url) as s:
+        # у пула total=60 с — для целого ролика мало; оставляем прежний лимит aiohttp по умолчанию
+        async with s.get(url, timeout=aiohttp.ClientTimeout(total=300)) as r:
             text = await r.text() if r.status >= 400 else None
             if r.status >= 400:
                 log.error("Luma video download failed %s\nBody: %s", r.status, text)
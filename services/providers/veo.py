@@ -4,11 +4,35 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import os
+import random
+import time
+from collections import OrderedDict
 from typing import Any, Optional
 
 import aiohttp
 
 from config import settings
+from providers.base import LRUCache, json_dumps, json_loads, parse_retry_after
+from utils.http_pool import lease
+
+# br объявляем, только если aiohttp сможет его распаковать (Brotli/brotlicffi установлен)
+try:
+    import brotli  # noqa: F401
+    _HAS_BROTLI = True
+except ImportError:  # pragma: no cover - зависит от окружения
+    try:
+        import brotlicffi  # noqa: F401
+        _HAS_BROTLI = True
+    except ImportError:
+        _HAS_BROTLI = False
+_ACCEPT_ENCODING = "gzip, deflate, br" if _HAS_BROTLI else "gzip, deflate"
+
+# msgspec (опционально): ответ LRO декодируется сразу в типизированные структуры
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - зависит от окружения
+    msgspec = None
 
 logger = logging.getLogger(__name__)
 
@@ -48,15 +72,16 @@ def _choose_model(speed: str) -> str:
     return DEFAULT_MODEL_FAST if s == "fast" else DEFAULT_MODEL_QUALITY
 
 
+_DEFAULT_ASPECT = "16:9"
+_ASPECT_MAP: dict[str, str] = {"16:9": "16:9", "9:16": "9:16"}
+
+
 def _aspect(a: str) -> str:
     """
     Поддерживаем только 16:9 и 9:16.
     Всё остальное мягко сводим к 16:9.
     """
-    a = (a or "").strip()
-    if a in ("16:9", "9:16"):
-        return a
-    return "16:9"
+    return _ASPECT_MAP.get(a.strip() if a else "", _DEFAULT_ASPECT)
 
 
 _ANTI_BORDERS = (
@@ -82,62 +107,226 @@ def _strong_ar_prompt(prompt: str, aspect: str) -> str:
     return f"{base} {tail}"
 
 
-async def _post(session: aiohttp.ClientSession, url: str, payload: dict, api_key: str) -> dict:
-    async with session.post(
-        url,
-        json=payload,
-        headers={"x-goog-api-key": api_key, "Content-Type": "application/json"},
-    ) as r:
-        text = await r.text()
-        if r.status >= 400:
-            logger.error("Veo(Google) POST %s failed %s: %s", url, r.status, text)
-            raise ValueError(f"Veo(Google) POST {url} failed {r.status}: {text}")
-        return await r.json()
+# url операции -> (ETag, последний ответ): пока операция не завершилась, GET идёт с If-None-Match.
+# Размер ограничен: операции, которые перестали опрашивать до завершения, вытесняются
+_poll_etags: LRUCache = LRUCache(256)
+
+
+# 429 и сбои шлюза Google — временные: повторяем с экспоненциальной паузой и джиттером;
+# остальные 4xx (400/401/403/404) — окончательные
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+_MAX_ATTEMPTS = 3
+_BACKOFF_BASE_SEC = 0.5
+_BACKOFF_CAP_SEC = 8.0
+_RETRY_AFTER_MAX_SEC = 30.0
+
+
+def _retry_delay(attempt: int, retry_after: Optional[str]) -> float:
+    server = parse_retry_after(retry_after)
+    if server is not None:
+        return min(server, _RETRY_AFTER_MAX_SEC)
+    return min(_BACKOFF_CAP_SEC, _BACKOFF_BASE_SEC * 2 ** attempt) + random.random() * 0.2
+
+
+async def _request(
+    session: aiohttp.ClientSession,
+    method: str,
+    url: str,
+    *,
+    headers: dict[str, str],
+    timeout: Optional[aiohttp.ClientTimeout],
+    **kwargs: Any,
+) -> tuple[aiohttp.ClientResponse, bytes]:
+    """Запрос с повторами на _RETRY_STATUSES и обрывах соединения; тело читается один раз байтами."""
+    # timeout=None отключил бы таймаут сессии (60 с) — передаём только явно заданный
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    for attempt in range(_MAX_ATTEMPTS):
+        last = attempt == _MAX_ATTEMPTS - 1
+        try:
+            async with session.request(method, url, headers=headers, **kwargs) as r:
+                body = await r.read()
+                if r.status not in _RETRY_STATUSES or last:
+                    return r, body
+                delay = _retry_delay(attempt, r.headers.get("Retry-After"))
+                logger.warning("Veo(Google) %s %s -> %s, retry in %.1fs", method, url, r.status, delay)
+        except aiohttp.ClientConnectionError as e:
+            if last:
+                raise
+            delay = _retry_delay(attempt, None)
+            logger.warning("Veo(Google) %s %s network error: %s, retry in %.1fs", method, url, e, delay)
+        await asyncio.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+async def _post(
+    session: aiohttp.ClientSession,
+    url: str,
+    payload: dict,
+    api_key: str,
+    *,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> dict:
+    headers = {
+        "x-goog-api-key": api_key,
+        "Content-Type": "application/json",
+        "Accept-Encoding": _ACCEPT_ENCODING,
+    }
+    # сериализуем сами (orjson, если есть): aiohttp с json= гонит payload через stdlib json.dumps
+    r, body = await _request(
+        session, "POST", url, headers=headers, timeout=timeout, data=json_dumps(payload)
+    )
+    # в текст — только для ошибки
+    if r.status >= 400:
+        text = body.decode("utf-8", "replace")
+        logger.error("Veo(Google) POST %s failed %s: %s", url, r.status, text)
+        raise ValueError(f"Veo(Google) POST {url} failed {r.status}: {text}")
+    return json_loads(body)
+
+
+async def _get_body(
+    session: aiohttp.ClientSession,
+    url: str,
+    api_key: str,
+    *,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> bytes:
+    """Сырое тело GET. ETag запоминается; кэш по url сбрасывает вызывающий, когда операция завершена."""
+    headers = {"x-goog-api-key": api_key, "Accept-Encoding": _ACCEPT_ENCODING}
+    cached = _poll_etags.get(url)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+    r, body = await _request(session, "GET", url, headers=headers, timeout=timeout)
+    # 304 — операция не изменилась: отдаём прошлое тело
+    if r.status == 304 and cached:
+        return cached[1]
+    if r.status >= 400:
+        text = body.decode("utf-8", "replace")
+        logger.error("Veo(Google) GET %s failed %s: %s", url, r.status, text)
+        raise ValueError(f"Veo(Google) GET {url} failed {r.status}: {text}")
+    etag = r.headers.get("ETag")
+    if etag:
+        _poll_etags[url] = (etag, body)
+    return body
+
+
+async def _get(
+    session: aiohttp.ClientSession,
+    url: str,
+    api_key: str,
+    *,
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> dict:
+    return json_loads(await _get_body(session, url, api_key, timeout=timeout))
+
+
+if msgspec is not None:
+    class _Video(msgspec.Struct):
+        uri: Optional[str] = None
+        downloadUri: Optional[str] = None
+
+    class _Sample(msgspec.Struct):
+        video: Optional[_Video] = None
+
+    class _GenerateVideoResponse(msgspec.Struct):
+        generatedSamples: list[_Sample] = []
+
+    class _OpResponse(msgspec.Struct):
+        generateVideoResponse: Optional[_GenerateVideoResponse] = None
+        uri: Optional[str] = None
+        downloadUri: Optional[str] = None
+        video: Optional[_Video] = None
+        resources: list[_Video] = []
+
+    class VeoOp(msgspec.Struct):
+        """Операция LRO: лишние поля ответа не декодируются вовсе."""
+        name: Optional[str] = None
+        done: bool = False
+        error: Any = None
+        response: Optional[_OpResponse] = None
+
+    _op_decoder = msgspec.json.Decoder(VeoOp)
+
+    def _decode_op(body: bytes) -> Optional["VeoOp"]:
+        try:
+            return _op_decoder.decode(body)
+        except msgspec.ValidationError:
+            return None  # нестандартная форма ответа — разберём словарём
+
+    def _op_video_uri(op: "VeoOp") -> Optional[str]:
+        """Тот же порядок поиска, что в _URI_PATHS, но по атрибутам."""
+        resp = op.response
+        if resp is None:
+            return None
+        gvr = resp.generateVideoResponse
+        if gvr is not None and gvr.generatedSamples:
+            video = gvr.generatedSamples[0].video
+            if video is not None and (video.uri or video.downloadUri):
+                return video.uri or video.downloadUri
+        if resp.uri or resp.downloadUri:
+            return resp.uri or resp.downloadUri
+        if resp.video is not None and (resp.video.uri or resp.video.downloadUri):
+            return resp.video.uri or resp.video.downloadUri
+        for it in resp.resources:
+            if it.uri or it.downloadUri:
+                return it.uri or it.downloadUri
+        return None
+else:
+    def _decode_op(body: bytes) -> None:
+        return None
+
+
+# где в ответе LRO лежит ссылка на видео — в порядке приоритета. Шаг пути: ключ dict,
+# индекс list, "*" — каждый элемент list; последний шаг-кортеж — альтернативные ключи
+_URI_KEYS = ("uri", "downloadUri")
+_URI_PATHS: tuple[tuple[Any, ...], ...] = (
+    # основной ожидаемый формат
+    ("response", "generateVideoResponse", "generatedSamples", 0, "video", _URI_KEYS),
+    # упрощённые варианты
+    ("response", _URI_KEYS),
+    ("response", "video", _URI_KEYS),
+    # иногда прилетает files API
+    ("response", "resources", "*", _URI_KEYS),
+)
 
 
-async def _get(session: aiohttp.ClientSession, url: str, api_key: str) -> dict:
-    async with session.get(url, headers={"x-goog-api-key": api_key}) as r:
-        text = await r.text()
-        if r.status >= 400:
-            logger.error("Veo(Google) GET %s failed %s: %s", url, r.status, text)
-            raise ValueError(f"Veo(Google) GET {url} failed {r.status}: {text}")
-        return await r.json()
+def _walk(node: Any, path: tuple[Any, ...]) -> Optional[str]:
+    """Проходит один путь без промежуточных `or {}`; None — как только путь оборвался."""
+    for i, step in enumerate(path):
+        if isinstance(step, tuple):
+            if not isinstance(node, dict):
+                return None
+            for k in step:
+                v = node.get(k)
+                if v:
+                    return v
+            return None
+        if step == "*":
+            if not isinstance(node, list):
+                return None
+            for item in node:
+                hit = _walk(item, path[i + 1:])
+                if hit:
+                    return hit
+            return None
+        if isinstance(node, dict):
+            node = node.get(step)
+        elif isinstance(node, list) and isinstance(step, int) and step < len(node):
+            node = node[step]
+        else:
+            return None
+    return node or None
 
 
 def _extract_video_uri(lro_response: dict) -> Optional[str]:
     """
     Достаём ссылку на видео из ответа LRO с разными вариантами расположения.
+    Пути из _URI_PATHS проверяются по порядку, до первого попадания.
     """
-    resp = (lro_response or {}).get("response") or {}
-
-    # Основной ожидаемый формат
-    gvr = resp.get("generateVideoResponse") or {}
-    samples = gvr.get("generatedSamples") or []
-    if samples:
-        video = (samples[0] or {}).get("video") or {}
-        uri = video.get("uri") or video.get("downloadUri")
-        if uri:
-            return uri
-
-    # Упрощённые варианты
-    uri = resp.get("uri") or resp.get("downloadUri")
-    if uri:
-        return uri
-
-    video = resp.get("video") or {}
-    if isinstance(video, dict):
-        uri = video.get("uri") or video.get("downloadUri")
+    for path in _URI_PATHS:
+        uri = _walk(lro_response, path)
         if uri:
             return uri
-
-    # Иногда прилетает files API
-    resources = resp.get("resources") or []
-    for it in resources:
-        if isinstance(it, dict):
-            uri = it.get("uri") or it.get("downloadUri")
-            if uri:
-                return uri
-
     return None
 
 
@@ -150,8 +339,9 @@ async def submit(prompt: str, aspect: str, speed: str) -> dict[str, Any]:
     model = _choose_model(speed)
     url = f"{BASE}/models/{model}:predictLongRunning"
 
+    aspect = _aspect(aspect)
     # Усиливаем ориентацию/безрамочность в тексте промпта (strict-ish AR).
-    prompt_text = _strong_ar_prompt(prompt, _aspect(aspect))
+    prompt_text = _strong_ar_prompt(prompt, aspect)
 
     # Параметры кладём в config — REST читает их из instances[0].
     # По умолчанию целимся в 1080p (лучше для Telegram/HQ).
@@ -160,7 +350,7 @@ async def submit(prompt: str, aspect: str, speed: str) -> dict[str, Any]:
             {
                 "prompt": prompt_text,
                 "config": {
-                    "aspectRatio": _aspect(aspect),
+                    "aspectRatio": aspect,
                     "resolution": "1080p",
                     # При необходимости можно добавить:
                     # "negativePrompt": "...",
@@ -171,36 +361,114 @@ async def submit(prompt: str, aspect: str, speed: str) -> dict[str, Any]:
         ]
     }
 
-    timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        data = await _post(session, url, payload, api_key)
-        op_name = data.get("name") or data.get("operation")
-        if not op_name:
-            raise ValueError(f"Не удалось получить имя операции из ответа: {data}")
-        logger.info("Google Veo operation started: %s", op_name)
-        return {"job_id": op_name}
+    async with lease(BASE) as session:
+        data = await _post(session, url, payload, api_key, timeout=aiohttp.ClientTimeout(total=60))
+    op_name = data.get("name") or data.get("operation")
+    if not op_name:
+        raise ValueError(f"Не удалось получить имя операции из ответа: {data}")
+    logger.info("Google Veo operation started: %s", op_name)
+    return {"job_id": op_name}
+
+
+# Кэш ответов poll: повторные/параллельные опросы одной операции (статус, прогресс, нотификатор)
+# в пределах TTL делят один GET. Итоговый статус уже не меняется — его держим дольше.
+_POLL_TTL_SEC = float(os.getenv("VEO_POLL_TTL", "2"))
+_POLL_TERMINAL_TTL_SEC = 60.0
+_POLL_CACHE_MAX = 256
+# job_id -> (истекает, результат); порядок вставки — для вытеснения самых старых записей
+_poll_cache: "OrderedDict[str, tuple[float, dict[str, Any]]]" = OrderedDict()
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _cache_poll_result(job_id: str, task: asyncio.Task) -> None:
+    _inflight.pop(job_id, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    info = task.result()
+    ttl = _POLL_TERMINAL_TTL_SEC if info["status"] in ("completed", "failed") else _POLL_TTL_SEC
+    now = time.monotonic()
+    _poll_cache.pop(job_id, None)
+    if len(_poll_cache) >= _POLL_CACHE_MAX:
+        for key in [k for k, (exp, _) in _poll_cache.items() if exp <= now]:
+            del _poll_cache[key]
+        # всё ещё свежие — вытесняем самые старые, чтобы кэш не рос сверх лимита
+        while len(_poll_cache) >= _POLL_CACHE_MAX:
+            _poll_cache.popitem(last=False)
+    _poll_cache[job_id] = (now + ttl, info)
 
 
 async def poll(job_id: str) -> dict[str, Any]:
     """
     Опрос долгой операции. Возвращает
       {"status": in_progress|completed|failed, "file_id": url|None}
+    Свежий результат (VEO_POLL_TTL) отдаётся из кэша; одновременные вызовы ждут один запрос.
     """
+    cached = _poll_cache.get(job_id)
+    if cached and cached[0] > time.monotonic():
+        return dict(cached[1])
+    task = _inflight.get(job_id)
+    if task is None:
+        task = asyncio.ensure_future(_poll_once(job_id))
+        _inflight[job_id] = task
+        task.add_done_callback(lambda t: _cache_poll_result(job_id, t))
+    # shield: отмена одного ожидающего не обрывает запрос остальным
+    return dict(await asyncio.shield(task))
+
+
+async def _poll_once(job_id: str) -> dict[str, Any]:
     api_key = _api_key()
     url = f"{BASE}/{job_id}"  # job_id приходит как 'operations/...'
 
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        data = await _get(session, url, api_key)
+    async with lease(BASE) as session:
+        body = await _get_body(session, url, api_key, timeout=aiohttp.ClientTimeout(total=30))
+
+    op = _decode_op(body)
+    if op is not None:
+        done, error = op.done, op.error
+    else:
+        data = json_loads(body)
+        done, error = data.get("done"), data.get("error")
 
-    if not data.get("done"):
+    if not done:
         return {"status": "in_progress", "file_id": None}
+    # операция завершена — условный GET по ней больше не нужен
+    _poll_etags.pop(url, None)
 
-    error = data.get("error")
     if error:
         # прокинем сообщение об ошибке в логи
         logger.error("Veo operation error: %s", error)
         return {"status": "failed", "file_id": None}
 
-    video_url = _extract_video_uri(data)
+    video_url = _op_video_uri(op) if op is not None else _extract_video_uri(data)
     return {"status": "completed", "file_id": video_url}
+
+
+async def wait_for_completion(
+    job_id: str,
+    *,
+    initial: float = 2.0,
+    multiplier: Optional[float] = None,
+    cap: float = 60.0,
+    deadline: float = 1800.0,
+) -> dict[str, Any]:
+    """
+    Ждёт завершения операции, опрашивая с растущим интервалом:
+    initial, initial*multiplier, … но не дольше cap между опросами.
+    Множитель по умолчанию — settings.VEO_POLL_BACKOFF.
+    Возвращает результат poll (completed/failed) либо {"status": "timeout", "file_id": None}.
+    """
+    if multiplier is None:
+        multiplier = float(getattr(settings, "VEO_POLL_BACKOFF", 1.5) or 1.5)
+    multiplier = max(1.0, multiplier)
+    stop_at = time.monotonic() + deadline
+    interval = initial
+    while True:
+        info = await poll(job_id)
+        if info["status"] in ("completed", "failed"):
+            return info
+        left = stop_at - time.monotonic()
+        if left <= 0:
+            logger.warning("Veo operation %s timed out after %.0fs", job_id, deadline)
+            return {"status": "timeout", "file_id": None}
+        await asyncio.sleep(min(interval, left))
+        interval = min(interval * multiplier, cap)
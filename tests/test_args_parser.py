@@ -0,0 +1,85 @@
+import shlex
+
+import pytest
+
+for _dep in ("aiohttp", "httpx", "dotenv", "pydantic"):
+    pytest.importorskip(_dep)
+
+from utils.args_parser import FlagParseError, _normalize_duration, _split_args, parse_veo_command
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        "a cat on a roof --ar 9:16",
+        'cat --neg="blurry faces" --fast',
+        "cat --neg='a b' dog",
+        'say "hello world" please',
+        'x"a b"y \'c\'',
+        "tabs\tand\nnewlines",
+        r"escaped\ space --neg a\"b",
+    ],
+)
+def test_split_args_matches_shlex(raw):
+    assert _split_args(raw) == shlex.split(raw)
+
+
+def test_split_args_unbalanced_quote_goes_to_shlex():
+    with pytest.raises(ValueError):
+        _split_args('cat --neg "blurry')
+    with pytest.raises(ValueError):
+        _split_args("it's a cat")
+
+
+def test_parse_flag_with_quoted_value():
+    params = parse_veo_command('/veo a cat --neg="a b" --ar=9:16 --fast').params
+
+    assert params.prompt == "a cat"
+    assert params.negative_prompt == "a b"
+    assert params.aspect_ratio == "9:16"
+    assert params.fast_mode is True
+
+
+def test_parse_flag_equals_value_forms():
+    params = parse_veo_command("/veo cat --resolution=1080p --model=veo3 --dur=8").params
+
+    assert params.prompt == "cat"
+    assert params.resolution == "1080p"
+    assert params.model == "veo3"
+    assert params.duration == "8s"
+
+
+def test_parse_flag_without_value():
+    with pytest.raises(FlagParseError):
+        parse_veo_command("/veo cat --ar")
+
+
+@pytest.mark.parametrize("value", ["8", "8s", " 8 S ", "8S"])
+def test_normalize_duration(value):
+    assert _normalize_duration(value) == "8s"
+
+
+@pytest.mark.parametrize("value", ["8.5s", "eight", "", "s"])
+def test_normalize_duration_rejects(value):
+    with pytest.raises(FlagParseError):
+        _normalize_duration(value)
+
+
+def test_parse_duration_with_spaces_and_fraction():
+    assert parse_veo_command('/veo cat --dur=" 8 S "').params.duration == "8s"
+    with pytest.raises(FlagParseError):
+        parse_veo_command("/veo cat --dur 8.5s")
+
+
+def test_repeated_parse_returns_fresh_params():
+    raw = "/veo sunset over the sea --ar 16:9"
+    first = parse_veo_command(raw).params
+    first.extras["seed"] = 42
+    first.prompt = "changed"
+
+    second = parse_veo_command(raw).params
+
+    assert second is not first
+    assert second.extras is not first.extras
+    assert second.extras == {}
+    assert second.prompt == "sunset over the sea"
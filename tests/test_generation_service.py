@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+for _dep in ("aiohttp", "httpx", "dotenv", "pydantic"):
+    pytest.importorskip(_dep)
+
+import services.generation_service as generation_service
+from providers.base import JobStatus, Provider
+
+
+def test_job_poller_shares_one_tick_between_waiters(monkeypatch):
+    calls = []
+
+    async def fake_poll_job(provider, job_id):
+        calls.append(job_id)
+        if calls.count(job_id) < 2:
+            return JobStatus(status="running")
+        return JobStatus(status="succeeded", extra={"job": job_id})
+
+    monkeypatch.setattr(generation_service, "poll_job", fake_poll_job)
+
+    async def scenario():
+        poller = generation_service.JobPoller(Provider.VEO3, interval_sec=0.01)
+        return await asyncio.gather(
+            poller.wait("job-1", timeout_sec=5),
+            poller.wait("job-1", timeout_sec=5),
+            poller.wait("job-2", timeout_sec=5),
+        )
+
+    first, second, other = asyncio.run(scenario())
+
+    assert first.status == second.status == other.status == "succeeded"
+    assert first.extra == {"job": "job-1"}
+    assert other.extra == {"job": "job-2"}
+    # два ожидающих одну задачу не удваивают запросы: по одному poll_job на задачу за тик
+    assert calls.count("job-1") == 2
+    assert calls.count("job-2") == 2
+
+
+def test_job_poller_wake_skips_pause(monkeypatch):
+    calls = []
+
+    async def fake_poll_job(provider, job_id):
+        calls.append(job_id)
+        status = "succeeded" if len(calls) > 1 else "running"
+        return JobStatus(status=status)
+
+    monkeypatch.setattr(generation_service, "poll_job", fake_poll_job)
+
+    async def scenario():
+        poller = generation_service.JobPoller(Provider.VEO3, interval_sec=60)
+        monkeypatch.setitem(generation_service._pollers, Provider.VEO3, poller)
+        waiter = asyncio.create_task(poller.wait("job-1", timeout_sec=5))
+        await asyncio.sleep(0.01)
+        assert generation_service.notify_job_update("job-1")
+        return await waiter
+
+    status = asyncio.run(asyncio.wait_for(scenario(), timeout=2))
+
+    assert status.status == "succeeded"
+    assert calls == ["job-1", "job-1"]
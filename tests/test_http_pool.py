@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from utils import http_pool
+
+
+class FakeSession:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def test_leased_session_survives_idle_cleanup(monkeypatch):
+    session = FakeSession()
+    monkeypatch.setattr(http_pool, "_pools", {"cdn.example": (session, 0.0)})
+    monkeypatch.setattr(http_pool, "_in_use", {})
+
+    async def scenario():
+        async with http_pool.lease("https://cdn.example/video.mp4") as leased:
+            assert leased is session
+            # долгая загрузка: сессия «простаивает» дольше лимита, но занята
+            await http_pool._close_idle(0)
+            assert not session.closed
+            assert "cdn.example" in http_pool._pools
+        await http_pool._close_idle(0)
+        await http_pool.close_all()
+
+    asyncio.run(scenario())
+
+    assert session.closed
+    assert http_pool._pools == {}
+
+
+def test_get_session_outside_event_loop_raises():
+    with pytest.raises(RuntimeError):
+        http_pool.get_session("https://api.example")
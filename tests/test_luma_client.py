@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+for _dep in ("aiohttp", "httpx", "dotenv", "pydantic"):
+    pytest.importorskip(_dep)
+
+import services.providers.luma as luma
+
+
+@pytest.fixture
+def fake_poll(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        sleeps.append(delay)
+
+    def install(*results):
+        pending = list(results)
+
+        async def poll(job_id):
+            item = pending.pop(0)
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        monkeypatch.setattr(luma, "poll", poll)
+        monkeypatch.setattr(luma.asyncio, "sleep", fake_sleep)
+        return sleeps
+
+    return install
+
+
+def test_wait_until_complete_backs_off_to_cap(fake_poll):
+    sleeps = fake_poll(*[{"status": "queued"}] * 6, {"status": "completed", "video_url": "v"})
+
+    result = asyncio.run(luma.wait_until_complete("job"))
+
+    assert result["final"] == "completed"
+    assert sleeps == [2.0, 3.0, 4.5, 6.75, 10.125, 15.0]
+
+
+def test_wait_until_complete_accepts_legacy_interval_sec(fake_poll):
+    sleeps = fake_poll(*[{"status": "queued"}] * 3, {"status": "completed", "video_url": "v"})
+
+    with pytest.deprecated_call():
+        result = asyncio.run(luma.wait_until_complete("job", interval_sec=3))
+
+    assert result["final"] == "completed"
+    assert sleeps == [2.0, 3, 3]
+
+
+def test_wait_until_complete_honours_retry_after_on_429(fake_poll):
+    sleeps = fake_poll(
+        luma.LumaHTTPError("Luma GET failed 429", 429, 4.0),
+        {"status": "completed", "video_url": "v"},
+    )
+
+    result = asyncio.run(luma.wait_until_complete("job"))
+
+    assert result["final"] == "completed"
+    assert len(sleeps) == 1 and 4.0 <= sleeps[0] <= 5.0
+
+
+def test_wait_until_complete_does_not_retry_4xx(fake_poll):
+    fake_poll(luma.LumaHTTPError("Luma GET failed 404", 404))
+
+    with pytest.raises(luma.LumaHTTPError):
+        asyncio.run(luma.wait_until_complete("job"))
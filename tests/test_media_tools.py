@@ -1,3 +1,9 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
 import services.media_tools as media_tools
 
 
@@ -17,6 +23,8 @@ def test_enforce_ar_no_bars_command(monkeypatch, tmp_path):
     vf_arg = cmd[cmd.index("-vf") + 1]
     assert "scale=1920:1080" in vf_arg
     assert "crop=1920:1080" in vf_arg
+    assert cmd[cmd.index("-loglevel") + 1] == "error"
+    assert "-nostats" in cmd
     assert cmd[-1] == str(tmp_path / "dst.mp4")
 
 
@@ -34,8 +42,502 @@ def test_build_vertical_blurpad_command(monkeypatch, tmp_path):
 
     cmd = captured["cmd"]
     fc_arg = cmd[cmd.index("-filter_complex") + 1]
-    assert "boxblur=20:1" in fc_arg
+    assert media_tools._BLURPAD_BG_VF in fc_arg
     assert "overlay=(W-w)/2:(H-h)/2" in fc_arg
     map_index = cmd.index("-map")
     assert cmd[map_index + 1] == "[vout]"
     assert cmd[-1] == str(tmp_path / "dst.mp4")
+
+
+def test_concat_with_crossfade_command(monkeypatch, tmp_path):
+    captured = {}
+
+    async def fake_run(cmd):
+        captured["cmd"] = cmd
+
+    probes = []
+
+    async def fake_probe_all(path):
+        probes.append(path)
+        return {"duration": 0.8, "has_audio": True, "video": None}
+
+    monkeypatch.setattr(media_tools, "_run_async", fake_run)
+    monkeypatch.setattr(media_tools, "_probe_all_async", fake_probe_all)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    asyncio.run(
+        media_tools.concat_with_crossfade(
+            tmp_path / "intro.mp4", tmp_path / "video.mp4", tmp_path / "out.mp4", fade_duration=0.4
+        )
+    )
+
+    cmd = captured["cmd"]
+    fc_arg = cmd[cmd.index("-filter_complex") + 1]
+    assert "xfade=transition=fade:duration=0.4:offset=0.4" in fc_arg
+    assert "[1:a]adelay=400|400[a]" in fc_arg
+    assert len(probes) == 2
+    assert cmd[-1] == str(tmp_path / "out.mp4")
+
+
+def test_concat_with_crossfade_without_fade_or_audio_is_concat_two(monkeypatch, tmp_path):
+    concat_calls = []
+
+    async def fake_probe_all(path):
+        return {"duration": 0.8, "has_audio": False, "video": None}
+
+    async def fake_concat_two(intro, video, out, **kwargs):
+        concat_calls.append((intro, video, out))
+
+    async def fail_run(cmd):
+        raise AssertionError("xfade graph must not run")
+
+    monkeypatch.setattr(media_tools, "_probe_all_async", fake_probe_all)
+    monkeypatch.setattr(media_tools, "concat_two", fake_concat_two)
+    monkeypatch.setattr(media_tools, "_run_async", fail_run)
+
+    asyncio.run(media_tools.concat_with_crossfade("intro.mp4", "video.mp4", "out.mp4", fade_duration=0))
+
+    assert concat_calls == [("intro.mp4", "video.mp4", "out.mp4")]
+    assert media_tools._xfade_filter(800, 400, True) is media_tools._xfade_filter(800, 400, True)
+
+
+def test_build_intro_and_concat_single_command(monkeypatch, tmp_path):
+    calls = []
+
+    async def fake_run(cmd):
+        calls.append(cmd)
+
+    async def fake_has_audio(_):
+        return False
+
+    monkeypatch.setattr(media_tools, "_run_async", fake_run)
+    monkeypatch.setattr(media_tools, "_has_audio_async", fake_has_audio)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    asyncio.run(
+        media_tools.build_intro_and_concat(
+            tmp_path / "intro.png", tmp_path / "video.mp4", tmp_path / "out.mp4",
+            width=1920, height=1080, duration=0.8, fade=0.4,
+        )
+    )
+
+    assert len(calls) == 1
+    cmd = calls[0]
+    assert cmd[cmd.index("-loop") + 1] == "1"
+    fc_arg = cmd[cmd.index("-filter_complex") + 1]
+    assert "[intro][main]xfade=transition=fade:duration=0.4" in fc_arg
+    assert "[1:a]" not in fc_arg
+    assert cmd[cmd.index("-filter_complex_threads") + 1] == str(media_tools.THREADS_PER_ENCODE)
+    assert cmd[-1] == str(tmp_path / "out.mp4")
+
+
+def test_concat_two_stream_copy_when_params_match(monkeypatch, tmp_path):
+    calls = []
+
+    async def fake_run(cmd):
+        calls.append(cmd)
+
+    async def fake_probe(_cmd):
+        return (
+            '{"streams": [{"codec_type": "video", "codec_name": "h264", "width": 1920, '
+            '"height": 1080, "r_frame_rate": "25/1", "pix_fmt": "yuv420p", '
+            '"sample_aspect_ratio": "1:1"}], "format": {"duration": "8.0"}}'
+        )
+
+    monkeypatch.setattr(media_tools, "_run_async", fake_run)
+    monkeypatch.setattr(media_tools, "_run_probe_async", fake_probe)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    asyncio.run(media_tools.concat_two(tmp_path / "a.mp4", tmp_path / "b.mp4", tmp_path / "out.mp4"))
+
+    cmd = calls[0]
+    assert cmd[cmd.index("-f") + 1] == "concat"
+    assert cmd[cmd.index("-c") + 1] == "copy"
+    assert "-filter_complex" not in cmd
+    assert not (tmp_path / "out.concat.txt").exists()
+
+
+@pytest.mark.parametrize(
+    "pix_fmt_b, sar_b",
+    [("yuv444p", "1:1"), ("yuv420p10le", "1:1"), ("yuv420p", "4:3")],
+)
+def test_concat_two_reencodes_when_pix_fmt_or_sar_differ(monkeypatch, tmp_path, pix_fmt_b, sar_b):
+    calls = []
+
+    async def fake_run(cmd):
+        calls.append(cmd)
+
+    async def fake_probe(cmd):
+        pix_fmt, sar = (pix_fmt_b, sar_b) if cmd[-1].endswith("b.mp4") else ("yuv420p", "1:1")
+        return (
+            '{"streams": [{"codec_type": "video", "codec_name": "h264", "width": 1920, '
+            f'"height": 1080, "r_frame_rate": "25/1", "pix_fmt": "{pix_fmt}", '
+            f'"sample_aspect_ratio": "{sar}"}}], "format": {{"duration": "8.0"}}}}'
+        )
+
+    monkeypatch.setattr(media_tools, "_run_async", fake_run)
+    monkeypatch.setattr(media_tools, "_run_probe_async", fake_probe)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    asyncio.run(media_tools.concat_two(tmp_path / "a.mp4", tmp_path / "b.mp4", tmp_path / "out.mp4"))
+
+    cmd = calls[-1]
+    assert "-filter_complex" in cmd
+    assert "copy" not in cmd
+    assert cmd[cmd.index("-pix_fmt") + 1] == "yuv420p"
+
+
+def test_probe_views_share_one_cached_ffprobe(monkeypatch, tmp_path):
+    calls = []
+
+    class FakeProc:
+        stdout = (
+            '{"streams": ['
+            '{"index": 0, "codec_type": "video", "codec_name": "h264", "width": 1280, '
+            '"height": 720, "r_frame_rate": "30/1", "avg_frame_rate": "30/1"},'
+            '{"index": 1, "codec_type": "audio", "codec_name": "aac"}'
+            '], "format": {"duration": "8.000000"}}'
+        )
+
+    def fake_probe(cmd):
+        calls.append(cmd)
+        return FakeProc()
+
+    monkeypatch.setattr(media_tools, "_run_probe", fake_probe)
+    monkeypatch.setattr(media_tools, "_probe_cache", {})
+    monkeypatch.setattr(media_tools, "av", None)
+    src = tmp_path / "clip.mp4"
+    src.write_bytes(b"x")
+
+    assert media_tools.probe_video(src) == (1280, 720, 30.0)
+    assert media_tools.probe_video(str(src)) == (1280, 720, 30.0)
+    assert media_tools.probe_duration(src) == 8.0
+    assert media_tools._has_audio(src) is True
+    info = media_tools.probe_all(src)
+    assert info["video"]["codec"] == "h264" and info["duration"] == 8.0
+    info["video"]["width"] = 1
+    assert media_tools.probe_video(src) == (1280, 720, 30.0)
+    assert len(calls) == 1
+
+    src.write_bytes(b"xx")
+    media_tools.probe_video(src)
+    assert len(calls) == 2
+
+
+
+def test_probe_prefers_pyav_and_falls_back_to_ffprobe(monkeypatch, tmp_path):
+    from fractions import Fraction
+    from types import SimpleNamespace as NS
+
+    class FakeContainer:
+        duration = 8_000_000
+
+        def __init__(self):
+            cc = NS(width=1080, height=1920, name="h264",
+                    sample_aspect_ratio=Fraction(1, 1), format=NS(name="yuv420p"))
+            self.streams = NS(
+                video=[NS(codec_context=cc, base_rate=Fraction(30, 1), average_rate=None)],
+                audio=[object()],
+            )
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    def fake_open(path):
+        if path.endswith("broken.mp4"):
+            raise ValueError("invalid data")
+        return FakeContainer()
+
+    ffprobe_calls = []
+
+    class FakeProc:
+        stdout = '{"streams": [], "format": {"duration": "2.5"}}'
+
+    def fake_probe(cmd):
+        ffprobe_calls.append(cmd)
+        return FakeProc()
+
+    monkeypatch.setattr(media_tools, "av", NS(open=fake_open, time_base=1_000_000))
+    monkeypatch.setattr(media_tools, "_run_probe", fake_probe)
+    monkeypatch.setattr(media_tools, "_probe_cache", {})
+    good = tmp_path / "clip.mp4"
+    broken = tmp_path / "broken.mp4"
+    good.write_bytes(b"x")
+    broken.write_bytes(b"x")
+
+    assert media_tools.probe_video(good) == (1080, 1920, 30.0)
+    assert media_tools._probe_all(good)["video"]["sar"] == "1:1"
+    assert asyncio.run(media_tools.probe_duration_async(good)) == 8.0
+    assert media_tools._has_audio(good) is True
+    assert ffprobe_calls == []
+
+    assert media_tools.probe_duration(broken) == 2.5
+    assert len(ffprobe_calls) == 1
+
+
+def test_enforce_ar_no_bars_async_matches_sync_command(monkeypatch, tmp_path):
+    captured = {}
+
+    def fake_run(cmd):
+        captured["sync"] = cmd
+
+    async def fake_run_async(cmd):
+        captured["async"] = cmd
+
+    async def fake_has_audio(_):
+        return True
+
+    monkeypatch.setattr(media_tools, "_run_sync", fake_run)
+    monkeypatch.setattr(media_tools, "_run_async", fake_run_async)
+    monkeypatch.setattr(media_tools, "_has_audio", lambda _: True)
+    monkeypatch.setattr(media_tools, "_has_audio_async", fake_has_audio)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    src, dst = tmp_path / "src.mp4", tmp_path / "dst.mp4"
+    media_tools.enforce_ar_no_bars(src, dst, "16:9")
+    asyncio.run(media_tools.enforce_ar_no_bars_async(src, dst, "16:9"))
+
+    assert captured["async"] == captured["sync"]
+
+
+def test_video_codec_args_env_override_and_fallback(monkeypatch):
+    monkeypatch.setenv("FFMPEG_ENCODER", "h264_nvenc")
+    media_tools._detect_encoder.cache_clear()
+    try:
+        args = media_tools._video_codec_args()
+        assert args[:2] == ["-c:v", "h264_nvenc"]
+        assert args[args.index("-cq") + 1] == "19" and "-crf" not in args
+        slow = media_tools._video_codec_args("quality")
+        assert slow[slow.index("-preset") + 1] == "p7"
+
+        monkeypatch.setenv("FFMPEG_ENCODER", "auto")
+        monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "/nonexistent/ffmpeg")
+        media_tools._detect_encoder.cache_clear()
+        fast = media_tools._video_codec_args()
+        assert fast[:2] == ["-c:v", "libx264"]
+        assert fast[fast.index("-preset") + 1] == media_tools.DEFAULT_PRESET
+        quality = media_tools._video_codec_args("quality")
+        assert quality[quality.index("-preset") + 1] == "slow"
+    finally:
+        media_tools._detect_encoder.cache_clear()
+
+
+def test_normalize_stream_pipes_chunks_to_stdin(monkeypatch, tmp_path):
+    dst = tmp_path / "out.mp4"
+    captured = {}
+
+    def fake_cmd(src, out, aspect, *, has_aud, hint):
+        captured.update(src=src, has_aud=has_aud, hint=hint)
+        code = f"import sys; open({out!r}, 'wb').write(sys.stdin.buffer.read())"
+        return [sys.executable, "-c", code]
+
+    monkeypatch.setattr(media_tools, "_enforce_ar_cmd", fake_cmd)
+
+    async def chunks():
+        for part in (b"abc", b"def", b"ghi"):
+            yield part
+
+    asyncio.run(media_tools.normalize_stream(chunks(), dst, "16:9"))
+
+    assert dst.read_bytes() == b"abcdefghi"
+    assert captured == {"src": "pipe:0", "has_aud": True, "hint": None}
+
+
+def test_build_vertical_blurpad_cuda_falls_back_to_cpu(monkeypatch, tmp_path):
+    calls = []
+
+    def fake_run(cmd):
+        calls.append(cmd)
+        if "h264_nvenc" in cmd:
+            raise RuntimeError("no CUDA device")
+
+    monkeypatch.setattr(media_tools, "_run_sync", fake_run)
+    monkeypatch.setattr(media_tools, "_has_audio", lambda _: False)
+    monkeypatch.setattr(media_tools, "_detect_letterbox_crop", lambda *a, **k: None)
+    monkeypatch.setattr(media_tools, "_cuda_filters_available", lambda: True)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    media_tools.build_vertical_blurpad(tmp_path / "src.mp4", tmp_path / "dst.mp4")
+
+    assert len(calls) == 2
+    gpu_fc = calls[0][calls[0].index("-filter_complex") + 1]
+    assert "hwupload_cuda" in gpu_fc and "overlay_cuda" in gpu_fc
+    assert "-pix_fmt" not in calls[0]
+    cpu_fc = calls[1][calls[1].index("-filter_complex") + 1]
+    assert media_tools._BLURPAD_BG_VF in cpu_fc
+
+
+def test_enforce_ar_no_bars_drops_probe_cache_for_output(monkeypatch, tmp_path):
+    dst = tmp_path / "dst.mp4"
+    dst.write_bytes(b"old")
+    key = media_tools._stat_key(str(dst))
+    monkeypatch.setattr(media_tools, "_probe_cache", {key: {"duration": 1.0, "has_audio": False, "video": None}})
+    monkeypatch.setattr(media_tools, "_run_sync", lambda cmd: None)
+    monkeypatch.setattr(media_tools, "_has_audio", lambda _: False)
+    monkeypatch.setattr(media_tools, "_detect_letterbox_crop", lambda *a, **k: None)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    media_tools.enforce_ar_no_bars(tmp_path / "src.mp4", dst, "16:9")
+
+    assert media_tools._probe_cache == {}
+    assert media_tools._stat_key(str(tmp_path / "missing.mp4")) is None
+
+
+def test_bin_paths_resolved_once_until_reset(monkeypatch, tmp_path):
+    fake = tmp_path / "ffmpeg"
+    fake.write_text("")
+    monkeypatch.setattr(media_tools, "_FFMPEG", media_tools._FFMPEG)
+    monkeypatch.setattr(media_tools, "_FFPROBE", media_tools._FFPROBE)
+    before = media_tools._ffmpeg_path()
+
+    monkeypatch.setenv("FFMPEG_PATH", str(fake))
+    assert media_tools._ffmpeg_path() == before
+
+    media_tools.reset_bin_cache()
+    assert media_tools._ffmpeg_path() == str(fake)
+
+
+def test_detect_letterbox_crop_samples_windows_and_unions(monkeypatch):
+    cmds = []
+    hints = iter([
+        b"[Parsed_cropdetect_0] crop=1920:800:0:140\n",
+        b"[Parsed_cropdetect_0] crop=1920:816:0:132\n",
+        b"[Parsed_cropdetect_0] crop=0:0:0:0\n",  # тёмный кадр не сужает кроп
+    ])
+
+    def fake_capture_many(batch):
+        cmds.extend(batch)
+        return [next(hints) for _ in batch]
+
+    monkeypatch.setattr(
+        media_tools, "_probe_all",
+        lambda _: {"duration": 10.0, "has_audio": False,
+                   "video": {"width": 1920, "height": 1080, "fps": 25.0, "codec": "h264"}},
+    )
+    monkeypatch.setattr(media_tools, "_run_capture_many", fake_capture_many)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    assert media_tools._detect_letterbox_crop("src.mp4") == (1920, 816, 0, 132)
+    assert [c[c.index("-ss") + 1] for c in cmds] == ["1.000", "5.000", "9.000"]
+    assert all(c[c.index("-frames:v") + 1] == "5" for c in cmds)
+
+
+def test_parse_crop_takes_last_hint_from_bytes_or_str():
+    blob = b"[Parsed_cropdetect_0] crop=1920:800:0:140\n[Parsed_cropdetect_0] crop=1920:816:0:132\n"
+    assert media_tools._parse_crop_from_stderr(blob) == (1920, 816, 0, 132)
+    assert media_tools._parse_crop_from_stderr(blob.decode()) == (1920, 816, 0, 132)
+    assert media_tools._parse_crop_from_stderr(b"no hints here") is None
+
+
+def test_run_capture_many_collects_stderr_in_order():
+    code = "import sys; sys.stderr.write(sys.argv[1])"
+    cmds = [[sys.executable, "-c", code, tag] for tag in ("a", "b", "c")]
+    assert media_tools._run_capture_many(cmds) == [b"a", b"b", b"c"]
+
+
+def test_run_async_kills_process_on_cancel(tmp_path):
+    pid_file = tmp_path / "pid"
+    code = f"import os, time; open({str(pid_file)!r}, 'w').write(str(os.getpid())); time.sleep(30)"
+
+    async def main():
+        task = asyncio.create_task(media_tools._run_async([sys.executable, "-c", code]))
+        while not pid_file.exists() or not pid_file.read_text():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return int(pid_file.read_text())
+
+    pid = asyncio.run(main())
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return
+    raise AssertionError("ffmpeg process outlived the cancelled task")
+
+
+def test_run_async_respects_encode_semaphore(monkeypatch, tmp_path):
+    log = tmp_path / "log"
+    code = (
+        "import sys, time; f = open(sys.argv[1], 'a'); f.write('start\\n'); f.flush(); "
+        "time.sleep(0.2); f.write('end\\n')"
+    )
+
+    async def main():
+        monkeypatch.setattr(media_tools, "_ENCODE_SEM", asyncio.Semaphore(1))
+        cmd = [sys.executable, "-c", code, str(log)]
+        await asyncio.gather(media_tools._run_async(cmd), media_tools._run_async(cmd))
+
+    asyncio.run(main())
+    assert log.read_text().split() == ["start", "end", "start", "end"]
+
+
+def test_probe_many_bounds_concurrency_and_keeps_order(monkeypatch):
+    active = 0
+    peak = 0
+
+    async def fake_probe(path):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return {"path": path}
+
+    monkeypatch.setattr(media_tools, "_probe_all_async", fake_probe)
+
+    paths = [f"clip{i}.mp4" for i in range(6)]
+    result = asyncio.run(media_tools.probe_many(paths, concurrency=2))
+
+    assert [r["path"] for r in result] == paths
+    assert peak == 2
+
+
+def test_enforce_ar_no_bars_remuxes_when_already_normalized(monkeypatch, tmp_path):
+    captured = {}
+    info = {
+        "duration": 8.0, "has_audio": True,
+        "video": {"width": 1920, "height": 1080, "fps": 25.0, "codec": "h264", "sar": "1:1", "pix_fmt": "yuv420p"},
+    }
+    monkeypatch.setattr(media_tools, "_run_sync", lambda cmd: captured.setdefault("cmd", cmd))
+    monkeypatch.setattr(media_tools, "_has_audio", lambda _: True)
+    monkeypatch.setattr(media_tools, "_detect_letterbox_crop", lambda *a, **k: None)
+    monkeypatch.setattr(media_tools, "_probe_all", lambda _: info)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    media_tools.enforce_ar_no_bars(tmp_path / "src.mp4", tmp_path / "dst.mp4", "16:9")
+
+    cmd = captured["cmd"]
+    assert cmd[cmd.index("-c") + 1] == "copy"
+    assert "-vf" not in cmd
+
+    info["video"]["sar"] = "4:3"
+    captured.clear()
+    media_tools.enforce_ar_no_bars(tmp_path / "src.mp4", tmp_path / "dst.mp4", "16:9")
+    assert "-vf" in captured["cmd"]
+
+    info["video"].update(width=1080, height=1920, sar="1:1")
+    captured.clear()
+    media_tools.build_vertical_blurpad(tmp_path / "src.mp4", tmp_path / "dst.mp4", hw="cpu")
+    assert captured["cmd"][captured["cmd"].index("-c") + 1] == "copy"
+    assert "-filter_complex" not in captured["cmd"]
+
+
+def test_fragmented_output_skips_faststart(monkeypatch, tmp_path):
+    captured = {}
+    monkeypatch.setattr(media_tools, "_run_sync", lambda cmd: captured.setdefault("cmd", cmd))
+    monkeypatch.setattr(media_tools, "_has_audio", lambda _: False)
+    monkeypatch.setattr(media_tools, "_detect_letterbox_crop", lambda *a, **k: None)
+    monkeypatch.setattr(media_tools, "_cuda_filters_available", lambda: False)
+    monkeypatch.setattr(media_tools, "_ffmpeg_path", lambda: "ffmpeg")
+
+    media_tools.build_vertical_blurpad(tmp_path / "src.mp4", tmp_path / "dst.mp4", fragmented=True)
+
+    cmd = captured["cmd"]
+    assert cmd[cmd.index("-movflags") + 1] == "+frag_keyframe+empty_moov+default_base_moof"
+    assert "+faststart" not in cmd
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+for _dep in ("aiohttp", "httpx", "dotenv", "pydantic"):
+    pytest.importorskip(_dep)
+
+import providers.veo3_provider as veo3_provider
+from providers.veo3_provider import Veo3Provider
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"{}", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeClient:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def get(self, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    sleeps = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        sleeps.append(delay)
+
+    def install(*responses):
+        fake = FakeClient(*responses)
+        monkeypatch.setattr(veo3_provider, "_get_client", lambda: fake)
+        monkeypatch.setattr(veo3_provider, "_auth_headers", lambda: {"Authorization": "Bearer k"})
+        monkeypatch.setattr(veo3_provider.asyncio, "sleep", fake_sleep)
+        return fake, sleeps
+
+    return install
+
+
+def test_poll_429_keeps_job_pending_with_retry_after(client):
+    fake, sleeps = client(FakeResponse(429, headers={"Retry-After": "7"}))
+
+    status = asyncio.run(Veo3Provider().poll("job-1"))
+
+    # 429 — лимит запросов, а не провал генерации: задача остаётся живой
+    assert status.status == "pending"
+    assert status.extra == {"http": 429, "retry_after": 7.0}
+    assert fake.calls == 1
+    assert sleeps == []
+
+
+def test_poll_final_5xx_keeps_job_pending(client):
+    fake, sleeps = client(FakeResponse(503), FakeResponse(502))
+
+    status = asyncio.run(Veo3Provider().poll("job-1"))
+
+    assert status.status == "pending"
+    assert status.extra == {"http": 502, "retry_after": None}
+    assert fake.calls == 2
+    assert len(sleeps) == 1
+
+
+def test_poll_5xx_then_success(client):
+    fake, _ = client(
+        FakeResponse(503),
+        FakeResponse(200, b'{"status": "succeeded", "output": {"url": "https://cdn/v.mp4"}}'),
+    )
+
+    status = asyncio.run(Veo3Provider().poll("job-1"))
+
+    assert status.status == "succeeded"
+    assert status.extra == {"video_url": "https://cdn/v.mp4"}
+    assert fake.calls == 2
+
+
+def test_poll_non_transient_4xx_fails(client):
+    fake, _ = client(FakeResponse(404))
+
+    status = asyncio.run(Veo3Provider().poll("job-1"))
+
+    assert status.status == "failed"
+    assert fake.calls == 1
@@ -0,0 +1,116 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+for _dep in ("aiohttp", "httpx", "dotenv", "pydantic"):
+    pytest.importorskip(_dep)
+
+import services.providers.veo as veo
+from providers.base import LRUCache
+
+
+class FakeResponse:
+    def __init__(self, status, body=b"{}", headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self._body = body
+
+    async def read(self):
+        return self._body
+
+
+class FakeRequest:
+    def __init__(self, response, delay):
+        self._response = response
+        self._delay = delay
+
+    async def __aenter__(self):
+        if self._delay:
+            await asyncio.sleep(self._delay)
+        return self._response
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    """Отдаёт заготовленные ответы по очереди и запоминает запросы."""
+
+    def __init__(self, *responses, delay=0.0):
+        self.responses = list(responses)
+        self.calls = []
+        self.delay = delay
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        return FakeRequest(self.responses.pop(0), self.delay)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        recorded.append(delay)
+
+    monkeypatch.setattr(veo.asyncio, "sleep", fake_sleep)
+    return recorded
+
+
+def test_request_retries_transient_status(sleeps):
+    session = FakeSession(FakeResponse(503), FakeResponse(200, b'{"ok": true}'))
+
+    r, body = asyncio.run(veo._request(session, "GET", "https://x/op", headers={}, timeout=None))
+
+    assert r.status == 200
+    assert body == b'{"ok": true}'
+    assert len(session.calls) == 2
+    assert len(sleeps) == 1
+    # timeout=None не передаётся: действует таймаут общей сессии
+    assert "timeout" not in session.calls[0][2]
+
+
+def test_request_does_not_retry_client_error(sleeps):
+    session = FakeSession(FakeResponse(400, b"bad request"))
+
+    r, body = asyncio.run(veo._request(session, "POST", "https://x/op", headers={}, timeout=None))
+
+    assert r.status == 400
+    assert body == b"bad request"
+    assert len(session.calls) == 1
+    assert sleeps == []
+
+
+@pytest.mark.parametrize("retry_after, expected", [("5", 5.0), ("120", veo._RETRY_AFTER_MAX_SEC)])
+def test_request_honours_retry_after(sleeps, retry_after, expected):
+    session = FakeSession(FakeResponse(429, headers={"Retry-After": retry_after}), FakeResponse(200))
+
+    r, _ = asyncio.run(veo._request(session, "GET", "https://x/op", headers={}, timeout=None))
+
+    assert r.status == 200
+    assert sleeps == [expected]
+
+
+def test_concurrent_polls_share_one_get(monkeypatch):
+    session = FakeSession(FakeResponse(200, b'{"done": false}'), delay=0.01)
+
+    @asynccontextmanager
+    async def fake_lease(_):
+        yield session
+
+    monkeypatch.setattr(veo, "lease", fake_lease)
+    monkeypatch.setattr(veo, "_api_key", lambda: "key")
+    monkeypatch.setattr(veo, "_poll_cache", type(veo._poll_cache)())
+    monkeypatch.setattr(veo, "_inflight", {})
+    monkeypatch.setattr(veo, "_poll_etags", LRUCache(8))
+
+    async def scenario():
+        return await asyncio.gather(veo.poll("operations/1"), veo.poll("operations/1"))
+
+    first, second = asyncio.run(scenario())
+
+    assert first == second == {"status": "in_progress", "file_id": None}
+    assert len(session.calls) == 1
+    # каждый вызывающий получает свою копию результата
+    assert first is not second
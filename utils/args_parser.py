@@ -3,8 +3,11 @@
 
 from __future__ import annotations
 
+import re
 import shlex
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Callable
 
 from providers.base import Provider
 from providers.models import GenerationParams
@@ -22,85 +25,179 @@ class FlagParseError(ValueError):
     """Raised when provided flags cannot be parsed."""
 
 
-def parse_veo_command(raw: str) -> ParsedArgs:
-    """Parse a /veo command with flag modifiers into generation params."""
+# shlex в POSIX-режиме делит только по этим пробельным символам
+_PLAIN_TOKEN_RE = re.compile(r"[^ \t\r\n]+")
+# токен из неэкранированных кусков и "..."/'...' вплотную друг к другу: --neg="blurry faces"
+_QUOTED_TOKEN_RE = re.compile(r"""(?:[^ \t\r\n"'\\]+|"[^"\\]*"|'[^']*')+""")
+_QUOTE_RE = re.compile(r""""([^"]*)"|'([^']*)'""")
+
+
+def _unquote(match: re.Match[str]) -> str:
+    dq = match.group(1)
+    return dq if dq is not None else match.group(2)
+
+
+def _split_args(raw: str) -> list[str]:
+    """Same tokens as shlex.split, via C-level regex; escapes and unbalanced quotes go to shlex."""
+    if "\\" in raw:
+        return shlex.split(raw)
+    if '"' not in raw and "'" not in raw:
+        return _PLAIN_TOKEN_RE.findall(raw)
+    tokens: list[str] = []
+    pos = 0
+    for m in _QUOTED_TOKEN_RE.finditer(raw):
+        if raw[pos:m.start()].strip(" \t\r\n"):
+            return shlex.split(raw)  # непарная кавычка — пусть shlex решает (и ругается) сам
+        tokens.append(_QUOTE_RE.sub(_unquote, m.group()))
+        pos = m.end()
+    if raw[pos:].strip(" \t\r\n"):
+        return shlex.split(raw)
+    return tokens
+
+
+class _TokenStream:
+    """Iterator over tokens; the value half of --flag=value is pushed back and read next."""
+
+    __slots__ = ("_it", "_pending")
+
+    def __init__(self, tokens: list[str]) -> None:
+        self._it = iter(tokens)
+        self._pending: str | None = None
+
+    def __iter__(self) -> _TokenStream:
+        return self
+
+    def __next__(self) -> str:
+        if self._pending is not None:
+            token, self._pending = self._pending, None
+            return token
+        return next(self._it)
+
+    def push(self, token: str) -> None:
+        self._pending = token
+
+    def value_for(self, flag: str) -> str:
+        value = next(self, None)
+        if value is None:
+            raise FlagParseError(f"{flag} flag requires a value")
+        return value
+
+
+@dataclass(slots=True)
+class _VeoFlags:
+    """Flag values collected while walking a /veo command."""
 
-    tokens = shlex.split(raw)
-    prompt_parts: list[str] = []
     aspect_ratio: str | None = None
     resolution: str | None = None
     duration: str | None = None
     negative_prompt: str | None = None
-    fast_mode = False
+    fast_mode: bool = False
     model: str | None = None
 
-    idx = 0
-    while idx < len(tokens):
-        token = tokens[idx]
 
+def _take_aspect(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.aspect_ratio = tokens.value_for("--ar")
+
+
+def _set_resolution_const(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.resolution = flag.lstrip("-")
+
+
+def _take_resolution(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.resolution = tokens.value_for("--resolution")
+
+
+def _take_duration(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.duration = _normalize_duration(tokens.value_for("--dur"))
+
+
+def _take_negative(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.negative_prompt = tokens.value_for("--neg")
+
+
+def _set_fast(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.fast_mode = True
+
+
+def _set_quality(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.fast_mode = False
+
+
+def _take_model(state: _VeoFlags, tokens: _TokenStream, flag: str) -> None:
+    state.model = tokens.value_for("--model")
+
+
+# flag -> handler: one dict lookup per token instead of an if/elif ladder
+_FLAG_HANDLERS: dict[str, Callable[[_VeoFlags, _TokenStream, str], None]] = {
+    "--ar": _take_aspect,
+    "--aspect": _take_aspect,
+    "--aspect-ratio": _take_aspect,
+    "--720p": _set_resolution_const,
+    "--1080p": _set_resolution_const,
+    "--resolution": _take_resolution,
+    "--dur": _take_duration,
+    "--duration": _take_duration,
+    "--neg": _take_negative,
+    "--negative": _take_negative,
+    "--fast": _set_fast,
+    "--quality": _set_quality,
+    "--slow": _set_quality,
+    "--model": _take_model,
+}
+
+
+def parse_veo_command(raw: str) -> ParsedArgs:
+    """Parse a /veo command with flag modifiers into generation params."""
+
+    cached = _parse_cached(raw)
+    # GenerationParams изменяемый (и extras — dict): каждому вызову свой экземпляр
+    params = replace(cached.params, extras=dict(cached.params.extras))
+    return ParsedArgs(params=params, raw_prompt=cached.raw_prompt)
+
+
+@lru_cache(maxsize=1024)
+def _parse_cached(raw: str) -> ParsedArgs:
+    """Повторы одной и той же команды («ещё раз») не токенизируются заново."""
+
+    tokens = _TokenStream(_split_args(raw))
+    prompt_parts: list[str] = []
+    state = _VeoFlags()
+
+    for token in tokens:
         if token.startswith("/veo"):
-            idx += 1
             continue
 
         if token.startswith("--") and "=" in token:
-            flag, value = token.split("=", 1)
-            tokens.insert(idx + 1, value)
-            token = flag
-
-        if token in {"--ar", "--aspect", "--aspect-ratio"}:
-            idx += 1
-            if idx >= len(tokens):
-                raise FlagParseError("--ar flag requires a value")
-            aspect_ratio = tokens[idx]
-        elif token in {"--720p", "--1080p"}:
-            resolution = token.lstrip("-")
-        elif token == "--resolution":
-            idx += 1
-            if idx >= len(tokens):
-                raise FlagParseError("--resolution flag requires a value")
-            resolution = tokens[idx]
-        elif token in {"--dur", "--duration"}:
-            idx += 1
-            if idx >= len(tokens):
-                raise FlagParseError("--dur flag requires a value")
-            duration = _normalize_duration(tokens[idx])
-        elif token in {"--neg", "--negative"}:
-            idx += 1
-            if idx >= len(tokens):
-                raise FlagParseError("--neg flag requires a value")
-            negative_prompt = tokens[idx]
-        elif token == "--fast":
-            fast_mode = True
-        elif token in {"--quality", "--slow"}:
-            fast_mode = False
-        elif token == "--model":
-            idx += 1
-            if idx >= len(tokens):
-                raise FlagParseError("--model flag requires a value")
-            model = tokens[idx]
-        else:
+            token, value = token.split("=", 1)
+            tokens.push(value)
+
+        handler = _FLAG_HANDLERS.get(token)
+        if handler is not None:
+            handler(state, tokens, token)
+        elif token:
+            # пустые токены ("" или хвост "--x=") не дают двойных пробелов в промпте
             prompt_parts.append(token)
 
-        idx += 1
-
     prompt = " ".join(prompt_parts).strip()
     params = GenerationParams(
         prompt=prompt,
         provider=Provider.VEO3,
-        aspect_ratio=aspect_ratio,
-        resolution=resolution,
-        duration=duration,
-        negative_prompt=negative_prompt,
-        model=model,
-        fast_mode=fast_mode,
+        aspect_ratio=state.aspect_ratio,
+        resolution=state.resolution,
+        duration=state.duration,
+        negative_prompt=state.negative_prompt,
+        model=state.model,
+        fast_mode=state.fast_mode,
     )
     return ParsedArgs(params=params, raw_prompt=prompt)
 
 
+# "8", "8s", " 8 S " -> "8s"
+_DURATION_RE = re.compile(r"\s*([0-9]+)\s*s?\s*", re.IGNORECASE)
+
+
 def _normalize_duration(value: str) -> str:
-    cleaned = value.strip().lower()
-    if cleaned.endswith("s"):
-        return cleaned
-    if cleaned.isdigit():
-        return f"{cleaned}s"
-    raise FlagParseError(f"Unsupported duration value: {value}")
+    m = _DURATION_RE.fullmatch(value)
+    if m is None:
+        raise FlagParseError(f"Unsupported duration value: {value}")
+    return f"{m.group(1)}s"
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Shared aiohttp sessions keyed by host.
+
+Use ``async with lease(url) as session`` around a request (and the reading of its body):
+a leased session is never closed by the idle cleanup, however long the download runs.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+# сессия, к которой не обращались дольше этого, закрывается фоновой чисткой
+MAX_POOL_IDLE_SEC = float(os.getenv("HTTP_POOL_MAX_IDLE_SEC", "600"))
+_CLEANUP_INTERVAL_SEC = 60.0
+# прокси из HTTP(S)_PROXY окружения — как у сессии LumaProvider
+_TRUST_ENV = os.getenv("HTTP_TRUST_ENV", "1").lower() in ("1", "true", "yes")
+
+# host -> (сессия, время последнего обращения)
+_pools: dict[str, tuple[aiohttp.ClientSession, float]] = {}
+# host -> сколько lease() сейчас держат его сессию (запрос/чтение тела ещё идёт)
+_in_use: dict[str, int] = {}
+_cleanup_task: Optional[asyncio.Task] = None
+
+
+def _host_of(url_or_host: str) -> str:
+    if "://" in url_or_host:
+        return urlsplit(url_or_host).hostname or url_or_host
+    return url_or_host
+
+
+def get_session(url_or_host: str) -> aiohttp.ClientSession:
+    """
+    Return the pooled session for the host of url_or_host, creating it on first use.
+
+    The idle cleanup only knows about calls to get_session(), so a request still running
+    after MAX_POOL_IDLE_SEC may lose its session; prefer lease() for anything long-lived.
+    Must be called from a coroutine: sessions and the cleanup task are bound to the running
+    event loop, so a call from sync code raises RuntimeError.
+    """
+    global _cleanup_task
+    loop = asyncio.get_running_loop()
+    host = _host_of(url_or_host)
+    entry = _pools.get(host)
+    session = entry[0] if entry else None
+    if session is None or session.closed:
+        # свой пул на хост: медленный хост не занимает соединения остальных
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100, limit_per_host=20, ttl_dns_cache=300, keepalive_timeout=60
+            ),
+            timeout=aiohttp.ClientTimeout(total=60),
+            auto_decompress=True,  # сжатые ответы (gzip/deflate/br) распаковываются прозрачно
+            trust_env=_TRUST_ENV,
+        )
+    _pools[host] = (session, time.monotonic())
+    if _cleanup_task is None or _cleanup_task.done():
+        _cleanup_task = loop.create_task(_cleanup_loop())
+    return session
+
+
+@asynccontextmanager
+async def lease(url_or_host: str) -> AsyncIterator[aiohttp.ClientSession]:
+    """Pooled session held for the duration of the block: idle cleanup skips it until release."""
+    host = _host_of(url_or_host)
+    session = get_session(host)
+    _in_use[host] = _in_use.get(host, 0) + 1
+    try:
+        yield session
+    finally:
+        left = _in_use.get(host, 1) - 1
+        if left > 0:
+            _in_use[host] = left
+        else:
+            _in_use.pop(host, None)
+        entry = _pools.get(host)
+        if entry is not None and entry[0] is session:
+            # отсчёт простоя — с конца запроса, а не с его начала
+            _pools[host] = (session, time.monotonic())
+
+
+async def _close_idle(max_idle: float) -> None:
+    now = time.monotonic()
+    for host, (session, last_used) in list(_pools.items()):
+        if now - last_used >= max_idle and not _in_use.get(host):
+            del _pools[host]
+            if not session.closed:
+                await session.close()
+            log.debug("Closed idle HTTP pool for %s", host)
+
+
+async def _cleanup_loop() -> None:
+    while _pools:
+        await asyncio.sleep(_CLEANUP_INTERVAL_SEC)
+        await _close_idle(MAX_POOL_IDLE_SEC)
+
+
+async def close_all() -> None:
+    """Close every pooled session (bot shutdown)."""
+    global _cleanup_task
+    if _cleanup_task is not None:
+        _cleanup_task.cancel()
+        _cleanup_task = None
+    sessions = [session for session, _ in _pools.values()]
+    _pools.clear()
+    _in_use.clear()
+    for session in sessions:
+        if not session.closed:
+            await session.close()